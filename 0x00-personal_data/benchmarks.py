@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+
+""" Benchmark suite for the personal data module
+This module measures:
+  - redaction throughput of filter_datum() and filter_datum_batch()
+    against the number of fields, the line length and the match density
+  - throughput of each filter_datum() engine against the size of the
+    field list
+  - the per-record cost of RedactingFormatter on its free-form and
+    structured paths, next to a plain logging.Formatter
+  - filter_json() against decoding, redacting and re-encoding each line
+    with the json module
+  - the cost of pseudonymizing values with stable tokens against plain
+    redaction, with and without the token cache
+  - the bytes redaction path against decoding, redacting and encoding
+  - bcrypt hash and verify latency of encrypt_password at several costs
+Example usage:
+    ./benchmarks.py --output bench.json
+Results are printed as they are measured and written as JSON, so runs
+of different releases can be compared to catch regressions.
+"""
+
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+from datetime import datetime
+from typing import Callable, List, Sequence
+
+import bcrypt
+
+from encrypt_password import hash_password, is_valid
+from filtered_logger import (PII_FIELDS, Pseudonymizer, RedactingFormatter,
+                             filter_datum, filter_datum_batch,
+                             filter_datum_bytes, filter_json,
+                             filter_lines_bytes)
+
+REDACTION = "***"
+SEPARATOR = ";"
+
+
+def make_lines(field_count: int, line_count: int, value_length: int = 0,
+               pii_count: int = None) -> List[str]:
+    """ Build `key=value;` log lines like the ones main() produces
+    Arguments:
+      field_count -- number of key=value pairs per line
+      line_count -- number of lines to build
+      value_length -- pad every value to this length
+      pii_count -- number of PII keys per line, all of PII_FIELDS fitting
+                   in the line by default
+    Returns:
+    A list of log lines, the PII_FIELDS come first on each line.
+    """
+    if pii_count is None:
+        pii_count = min(field_count, len(PII_FIELDS))
+    keys = list(PII_FIELDS[:pii_count]) + [
+        'field_{}'.format(i) for i in range(field_count - pii_count)]
+    lines = []
+    for row in range(line_count):
+        values = ['value_{}_{}'.format(row, i).ljust(value_length, 'x')
+                  for i in range(field_count)]
+        lines.append(SEPARATOR.join('{}={}'.format(key, value)
+                                    for key, value in zip(keys, values)) +
+                     SEPARATOR)
+    return lines
+
+
+def measure(run: Callable[[], object], repeat: int = 5) -> float:
+    """ Time a callable and keep the best of several runs
+    Arguments:
+      run -- callable to time
+      repeat -- number of runs
+    Returns:
+    The best wall-clock time, in seconds.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_redaction(lines: List[str]) -> dict:
+    """ Measure both redaction engines on the same lines
+    Arguments:
+      lines -- log lines to redact
+    Returns:
+    A dictionary with the lines per second of each engine.
+    """
+    # Both engines must agree before we compare their speed
+    expected = [filter_datum(PII_FIELDS, REDACTION, line, SEPARATOR)
+                for line in lines]
+    assert filter_datum_batch(
+        PII_FIELDS, REDACTION, lines, SEPARATOR) == expected
+
+    regex_time = measure(lambda: [
+        filter_datum(PII_FIELDS, REDACTION, line, SEPARATOR)
+        for line in lines])
+    batch_time = measure(lambda: filter_datum_batch(
+        PII_FIELDS, REDACTION, lines, SEPARATOR))
+    return {
+        'line_length': sum(map(len, lines)) // len(lines),
+        'regex_lines_per_sec': len(lines) / regex_time,
+        'batch_lines_per_sec': len(lines) / batch_time,
+        'speedup': regex_time / batch_time,
+    }
+
+
+def bench_field_count(field_counts: Sequence[int] = (5, 20, 100),
+                      line_count: int = 10000) -> List[dict]:
+    """ Redaction throughput against the number of fields per line
+    Arguments:
+      field_counts -- numbers of fields per line to benchmark
+      line_count -- number of lines redacted per run
+    Returns:
+    A list of result dictionaries, one per field count.
+    """
+    return [dict(bench_redaction(make_lines(field_count, line_count)),
+                 fields=field_count) for field_count in field_counts]
+
+
+def bench_line_length(value_lengths: Sequence[int] = (16, 128, 1024),
+                      line_count: int = 10000) -> List[dict]:
+    """ Redaction throughput against the length of the values
+    Arguments:
+      value_lengths -- lengths every value is padded to
+      line_count -- number of lines redacted per run
+    Returns:
+    A list of result dictionaries, one per value length.
+    """
+    return [dict(bench_redaction(make_lines(10, line_count, value_length)),
+                 value_length=value_length)
+            for value_length in value_lengths]
+
+
+def bench_match_density(pii_counts: Sequence[int] = (0, 1, 3, 5),
+                        line_count: int = 10000) -> List[dict]:
+    """ Redaction throughput against the share of redacted fields
+    Arguments:
+      pii_counts -- numbers of PII fields among the 10 fields of a line
+      line_count -- number of lines redacted per run
+    Returns:
+    A list of result dictionaries, one per density.
+    """
+    return [dict(bench_redaction(make_lines(10, line_count,
+                                            pii_count=pii_count)),
+                 match_density=pii_count / 10)
+            for pii_count in pii_counts]
+
+
+def bench_field_list_size(list_sizes: Sequence[int] = (5, 50, 500),
+                          line_count: int = 10000) -> List[dict]:
+    """ Throughput of every filter_datum() engine against the field list
+    The lines keep 20 fields, the field list grows with compliance names
+    that never match, which is what slows a regex alternation down.
+    Arguments:
+      list_sizes -- numbers of fields to redact
+      line_count -- number of lines redacted per run
+    Returns:
+    A list of result dictionaries, one per field list size.
+    """
+    lines = make_lines(20, line_count)
+    results = []
+    for list_size in list_sizes:
+        fields = list(PII_FIELDS) + [
+            'compliance_field_{}'.format(i)
+            for i in range(list_size - len(PII_FIELDS))]
+        result = {'field_list_size': list_size}
+        for engine in ('auto', 'regex', 'tokenizer'):
+            elapsed = measure(lambda: [
+                filter_datum(fields, REDACTION, line, SEPARATOR, engine)
+                for line in lines])
+            result['{}_lines_per_sec'.format(engine)] = line_count / elapsed
+        results.append(result)
+    return results
+
+
+def bench_formatter(field_counts: Sequence[int] = (5, 20),
+                    record_count: int = 10000) -> List[dict]:
+    """ Per-record cost of RedactingFormatter on both of its paths
+    The same data is logged as a `key=value;` message, which is scanned
+    after formatting, and as a `fields` dict, which is redacted by key.
+    A plain logging.Formatter on the message gives the baseline.
+    Arguments:
+      field_counts -- numbers of fields per record to benchmark
+      record_count -- number of records formatted per run
+    Returns:
+    A list of result dictionaries, one per field count.
+    """
+    formatter = RedactingFormatter(PII_FIELDS)
+    plain = logging.Formatter(RedactingFormatter.FORMAT)
+    results = []
+    for field_count in field_counts:
+        line = make_lines(field_count, 1)[0]
+        data = dict(pair.split('=', 1)
+                    for pair in line.split(SEPARATOR) if pair)
+        free_form = [logging.LogRecord('user_data', logging.INFO, __file__,
+                                       0, line, None, None)
+                     for _ in range(record_count)]
+        structured = []
+        for _ in range(record_count):
+            record = logging.LogRecord('user_data', logging.INFO, __file__,
+                                       0, "", None, None)
+            record.fields = data
+            structured.append(record)
+
+        plain_time = measure(lambda: list(map(plain.format, free_form)))
+        free_time = measure(lambda: list(map(formatter.format, free_form)))
+        structured_time = measure(
+            lambda: list(map(formatter.format, structured)))
+        results.append({
+            'fields': field_count,
+            'plain_us_per_record': plain_time / record_count * 1e6,
+            'free_form_us_per_record': free_time / record_count * 1e6,
+            'structured_us_per_record': structured_time / record_count * 1e6,
+            'free_form_overhead_us': (free_time - plain_time) /
+            record_count * 1e6,
+        })
+    return results
+
+
+def _redact_decoded(document, fields: frozenset, redaction: str,
+                    path: str = ''):
+    """ Reference JSON redaction on a decoded document
+    Arguments:
+      document -- decoded JSON value
+      fields -- set of keys or dotted key paths to obfuscate
+      redaction -- string to replace values with
+      path -- dotted path of the document
+    Returns:
+    The redacted JSON value.
+    """
+    if isinstance(document, dict):
+        result = {}
+        for key, value in document.items():
+            key_path = '{}.{}'.format(path, key) if path else key
+            result[key] = redaction if key in fields or key_path in fields \
+                else _redact_decoded(value, fields, redaction, key_path)
+        return result
+    if isinstance(document, list):
+        return [_redact_decoded(value, fields, redaction, path)
+                for value in document]
+    return document
+
+
+def bench_json(line_count: int = 10000) -> List[dict]:
+    """ filter_json() against a json.loads/json.dumps round trip
+    Arguments:
+      line_count -- number of NDJSON lines redacted per run
+    Returns:
+    A list of result dictionaries, one per share of lines holding PII.
+    """
+    fields = list(PII_FIELDS) + ['request.headers.authorization']
+    field_set = frozenset(fields)
+    results = []
+    for pii_share in (0.0, 0.1, 1.0):
+        lines = []
+        for row in range(line_count):
+            user = {'id': row, 'role': 'member'}
+            if row < pii_share * line_count:
+                user.update(email='u{}@example.com'.format(row),
+                            name='User {}'.format(row))
+            lines.append(json.dumps({
+                'ts': 1700000000 + row, 'level': 'INFO',
+                'msg': 'request served', 'user': user,
+                'request': {'path': '/api/v1/users', 'status': 200,
+                            'headers': {'authorization': 'Bearer x',
+                                        'accept': '*/*'}},
+                'tags': ['api', 'v1'],
+            }))
+
+        def round_trip():
+            return [json.dumps(_redact_decoded(json.loads(line), field_set,
+                                               REDACTION))
+                    for line in lines]
+        expected = round_trip()
+        assert [json.loads(filter_json(fields, REDACTION, line))
+                for line in lines] == list(map(json.loads, expected))
+
+        stdlib_time = measure(round_trip)
+        scan_time = measure(lambda: [filter_json(fields, REDACTION, line)
+                                     for line in lines])
+        results.append({
+            'pii_share': pii_share,
+            'stdlib_lines_per_sec': line_count / stdlib_time,
+            'filter_json_lines_per_sec': line_count / scan_time,
+            'speedup': stdlib_time / scan_time,
+        })
+    return results
+
+
+def bench_pseudonymization(user_counts: Sequence[int] = (100, 10000),
+                           line_count: int = 10000) -> List[dict]:
+    """ Cost of pseudonymization tokens against plain redaction
+    Arguments:
+      user_counts -- numbers of distinct users the lines are spread over,
+                     the fewer users, the more the token cache hits
+      line_count -- number of lines redacted per run
+    Returns:
+    A list of result dictionaries, one per number of users.
+    """
+    results = []
+    for user_count in user_counts:
+        lines = ['name=User {0};email=u{0}@example.com;phone=555-{0:04d};'
+                 'ssn=000-00-{0:04d};password=pw{0};ip=10.0.0.1;'
+                 'last_login=2024-01-01;user_agent=curl;'
+                 .format(row % user_count) for row in range(line_count)]
+        cached = Pseudonymizer(b'benchmark key')
+        uncached = Pseudonymizer(b'benchmark key', cache_size=0)
+        assert [filter_datum(PII_FIELDS, cached, line, SEPARATOR)
+                for line in lines[:100]] == \
+            [filter_datum(PII_FIELDS, uncached, line, SEPARATOR)
+             for line in lines[:100]]
+
+        redaction_time = measure(lambda: [
+            filter_datum(PII_FIELDS, REDACTION, line, SEPARATOR)
+            for line in lines])
+        cached.clear_cache()
+        cached_time = measure(lambda: [
+            filter_datum(PII_FIELDS, cached, line, SEPARATOR)
+            for line in lines])
+        uncached_time = measure(lambda: [
+            filter_datum(PII_FIELDS, uncached, line, SEPARATOR)
+            for line in lines])
+        results.append({
+            'users': user_count,
+            'redaction_lines_per_sec': line_count / redaction_time,
+            'cached_lines_per_sec': line_count / cached_time,
+            'uncached_lines_per_sec': line_count / uncached_time,
+            'cache_hit_rate': cached.hit_rate,
+            'cached_cost': cached_time / redaction_time,
+            'uncached_cost': uncached_time / redaction_time,
+        })
+    return results
+
+
+def bench_bytes(value_lengths: Sequence[int] = (16, 128),
+                line_count: int = 10000) -> List[dict]:
+    """ Bytes redaction against a decode, filter_datum, encode round trip
+    Arguments:
+      value_lengths -- lengths every value is padded to
+      line_count -- number of lines redacted per run
+    Returns:
+    A list of result dictionaries, one per value length.
+    """
+    results = []
+    for value_length in value_lengths:
+        lines = [line.encode() for line in
+                 make_lines(10, line_count, value_length)]
+        block = b'\n'.join(lines)
+
+        def round_trip():
+            return [filter_datum(PII_FIELDS, REDACTION, line.decode(),
+                                 SEPARATOR).encode() for line in lines]
+
+        def per_line():
+            # One buffer reused for every line, like a log shipper would
+            out = bytearray()
+            for line in lines:
+                del out[:]
+                filter_datum_bytes(PII_FIELDS, REDACTION, line, SEPARATOR,
+                                   out)
+        expected = round_trip()
+        assert bytes(filter_lines_bytes(PII_FIELDS, REDACTION, block,
+                                        SEPARATOR)) == b'\n'.join(expected)
+
+        str_time = measure(round_trip)
+        bytes_time = measure(per_line)
+        block_time = measure(lambda: filter_lines_bytes(
+            PII_FIELDS, REDACTION, block, SEPARATOR))
+        results.append({
+            'value_length': value_length,
+            'str_lines_per_sec': line_count / str_time,
+            'bytes_lines_per_sec': line_count / bytes_time,
+            'block_lines_per_sec': line_count / block_time,
+            'speedup': str_time / bytes_time,
+            'block_speedup': str_time / block_time,
+        })
+    return results
+
+
+def bench_bcrypt(costs: Sequence[int] = (4, 8, 10, 12),
+                 repeat: int = 3) -> List[dict]:
+    """ Latency of hashing and verifying a password at several costs
+    Arguments:
+      costs -- bcrypt cost factors (log2 rounds) to benchmark
+      repeat -- number of runs per cost, the best one is kept
+    Returns:
+    A list of result dictionaries, one per cost.
+    """
+    password = "correct horse battery staple"
+    results = []
+    for cost in costs:
+        salt = bcrypt.gensalt(rounds=cost)
+        hashed = bcrypt.hashpw(password.encode(), salt)
+        hash_time = measure(
+            lambda: bcrypt.hashpw(password.encode(), salt), repeat)
+        verify_time = measure(lambda: is_valid(hashed, password), repeat)
+        results.append({
+            'cost': cost,
+            'hash_ms': hash_time * 1e3,
+            'verify_ms': verify_time * 1e3,
+        })
+    # hash_password() itself runs at the default cost
+    default_time = measure(lambda: hash_password(password), repeat)
+    results.append({'cost': 'default', 'hash_ms': default_time * 1e3})
+    return results
+
+
+def run_suite(quick: bool = False) -> dict:
+    """ Run every benchmark
+    Arguments:
+      quick -- use fewer lines and skip the slowest bcrypt cost
+    Returns:
+    A JSON serializable dictionary with the environment and the results.
+    """
+    lines = 1000 if quick else 10000
+    suites = {
+        'field_count': lambda: bench_field_count(line_count=lines),
+        'line_length': lambda: bench_line_length(line_count=lines),
+        'match_density': lambda: bench_match_density(line_count=lines),
+        'field_list_size': lambda: bench_field_list_size(line_count=lines),
+        'formatter': lambda: bench_formatter(record_count=lines),
+        'json': lambda: bench_json(line_count=lines),
+        'pseudonymization': lambda: bench_pseudonymization(
+            line_count=lines),
+        'bytes': lambda: bench_bytes(line_count=lines),
+        'bcrypt': lambda: bench_bcrypt(costs=(4, 8, 10) if quick
+                                       else (4, 8, 10, 12)),
+    }
+    results = {}
+    for name, run in suites.items():
+        results[name] = run()
+        for result in results[name]:
+            print(name, json.dumps(result), file=sys.stderr)
+    return {
+        'timestamp': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def main(argv: List[str] = None):
+    """
+    Main function to run the suite from the command line.
+    Arguments:
+      argv -- command line arguments, sys.argv[1:] by default
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the personal data module")
+    parser.add_argument('--output', help="JSON results file "
+                        "(default: stdout)")
+    parser.add_argument('--quick', action='store_true',
+                        help="smaller inputs, for a fast sanity run")
+    args = parser.parse_args(argv)
+
+    report = run_suite(args.quick)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,21 +3,169 @@
 """ Hash Password Module.
 This module provides a hash_password function that takes in a password string.
 The function returns a salted, hashed password, which is a byte string.
+For bulk jobs, hash_passwords() and verify_many() spread the bcrypt work
+across a pool of processes.
+The bcrypt cost can be calibrated to a latency target in milliseconds,
+set PERSONAL_DATA_BCRYPT_TARGET_MS or call calibrate_cost(). It never goes
+below PERSONAL_DATA_BCRYPT_MIN_COST, SAFE_BCRYPT_COST by default.
 """
 
+import json
+import os
+import platform
+import time
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from typing import Iterable, Iterator, List, Tuple
+
 import bcrypt
 
+# Default number of passwords sent to a worker process at once
+HASH_CHUNK_SIZE = 16
+# Bounds of the bcrypt cost (log2 of the rounds) and the bcrypt default
+MIN_BCRYPT_COST = 4
+MAX_BCRYPT_COST = 16
+DEFAULT_BCRYPT_COST = 12
+# Lowest cost calibration may pick, whatever the latency target
+SAFE_BCRYPT_COST = 10
+# File caching the calibrated cost, so later starts skip the benchmark
+BCRYPT_COST_FILE = '.bcrypt_cost.json'
+
+# Cost used by hash_password(), resolved on first use
+_bcrypt_cost = None
+
+
+def _time_hash(cost: int) -> float:
+    """ Time one bcrypt hash at a given cost.
+    Arguments:
+      cost(int) -- bcrypt cost factor
+    Returns:
+      The elapsed time, in milliseconds.
+    """
+    salt = bcrypt.gensalt(rounds=cost)
+    start = time.perf_counter()
+    bcrypt.hashpw(b'calibration password', salt)
+    return (time.perf_counter() - start) * 1000
+
+
+def _warn_missed(cost: int, elapsed: float, target_ms: float):
+    """ Warns that the minimum cost misses the latency target.
+    Arguments:
+      cost(int) -- minimum bcrypt cost, used anyway
+      elapsed(float) -- time of one hash at that cost, in milliseconds
+      target_ms(float) -- latency budget of one hash, in milliseconds
+    """
+    warnings.warn("bcrypt cost {} takes {:.0f} ms, over the {} ms target, "
+                  "using it anyway".format(cost, elapsed, target_ms),
+                  RuntimeWarning, stacklevel=3)
 
-def hash_password(password: str) -> bytes:
+
+def calibrate_cost(target_ms: float, cache_file: str = None,
+                   force: bool = False, min_cost: int = None) -> int:
+    """ Picks the largest bcrypt cost that hashes within a latency target.
+    The cost never goes below min_cost: if even min_cost misses the
+    target, a RuntimeWarning is issued and min_cost is used.
+    The result is cached per target, minimum and host in cache_file, a
+    later call reads it back instead of benchmarking again, unless force
+    is set. The chosen cost becomes the one used by hash_password().
+    Arguments:
+      target_ms(float) -- latency budget of one hash, in milliseconds
+      cache_file(str) -- path of the cache, PERSONAL_DATA_BCRYPT_COST_FILE
+                         or BCRYPT_COST_FILE by default
+      force(bool) -- benchmark even if the cache has a cost
+      min_cost(int) -- lowest acceptable cost,
+                       PERSONAL_DATA_BCRYPT_MIN_COST or SAFE_BCRYPT_COST
+                       by default
+    Returns:
+      The chosen cost, at least min_cost.
+    """
+    global _bcrypt_cost
+    cache_file = cache_file or os.getenv('PERSONAL_DATA_BCRYPT_COST_FILE',
+                                         BCRYPT_COST_FILE)
+    if min_cost is None:
+        min_cost = int(os.getenv('PERSONAL_DATA_BCRYPT_MIN_COST',
+                                 SAFE_BCRYPT_COST))
+    if not MIN_BCRYPT_COST <= min_cost <= MAX_BCRYPT_COST:
+        raise ValueError("min_cost must be between {} and {}".format(
+            MIN_BCRYPT_COST, MAX_BCRYPT_COST))
+    host = platform.node()
+
+    cached = None
+    if not force:
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = None
+    if isinstance(cached, dict) and cached.get('target_ms') == target_ms \
+            and cached.get('host') == host \
+            and cached.get('min_cost') == min_cost \
+            and min_cost <= cached.get('cost', 0) <= MAX_BCRYPT_COST:
+        _bcrypt_cost = cached['cost']
+        if cached.get('missed_ms'):
+            _warn_missed(_bcrypt_cost, cached['missed_ms'], target_ms)
+        return _bcrypt_cost
+
+    # Each extra cost doubles the work: stop when the next one won't fit
+    cost = min_cost
+    missed_ms = None
+    while cost < MAX_BCRYPT_COST:
+        elapsed = min(_time_hash(cost), _time_hash(cost))
+        if elapsed > target_ms:
+            if cost == min_cost:
+                missed_ms = elapsed
+                _warn_missed(cost, elapsed, target_ms)
+                break
+            cost -= 1
+            break
+        if elapsed * 2 > target_ms:
+            break
+        cost += 1
+
+    # Write the cache atomically so a concurrent start never reads half
+    temp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump({'target_ms': target_ms, 'host': host,
+                       'min_cost': min_cost, 'cost': cost,
+                       'missed_ms': missed_ms}, f)
+        os.replace(temp_file, cache_file)
+    except OSError:
+        pass
+    _bcrypt_cost = cost
+    return cost
+
+
+def get_bcrypt_cost() -> int:
+    """ Gets the bcrypt cost used by hash_password().
+    Calibrated on first use when PERSONAL_DATA_BCRYPT_TARGET_MS is set,
+    DEFAULT_BCRYPT_COST otherwise.
+    Returns:
+      The bcrypt cost factor.
+    """
+    if _bcrypt_cost is None:
+        target_ms = os.getenv('PERSONAL_DATA_BCRYPT_TARGET_MS')
+        if target_ms:
+            return calibrate_cost(float(target_ms))
+        return DEFAULT_BCRYPT_COST
+    return _bcrypt_cost
+
+
+def hash_password(password: str, cost: int = None) -> bytes:
     """ Hashes a password using the bcrypt algorithm.
     Arguments:
       password(str) -- a string to be hashed
+      cost(int) -- bcrypt cost factor, get_bcrypt_cost() by default
     Returns:
       A byte string.
     """
     hashed_pwd = password.encode()  # Convert the password to bytes
     # Generate a salt and hash the password
-    salted_hash = bcrypt.hashpw(hashed_pwd, bcrypt.gensalt())
+    salt = bcrypt.gensalt(rounds=cost or get_bcrypt_cost())
+    salted_hash = bcrypt.hashpw(hashed_pwd, salt)
     return salted_hash
 
 
@@ -30,3 +178,95 @@ def is_valid(hashed_password: bytes, password: str) -> bool:
       A boolean.
     """
     return bcrypt.checkpw(password.encode(), hashed_password)
+
+
+def _hash_chunk(passwords: List[str], cost: int) -> List[bytes]:
+    """ Hash a chunk of passwords, runs in a worker process.
+    Arguments:
+      passwords(list) -- strings to be hashed
+      cost(int) -- bcrypt cost factor
+    Returns:
+      A list of byte strings, in input order.
+    """
+    return [hash_password(password, cost) for password in passwords]
+
+
+def _verify_chunk(pairs: List[Tuple[bytes, str]]) -> List[bool]:
+    """ Validate a chunk of passwords, runs in a worker process.
+    Arguments:
+      pairs(list) -- (hashed_password, password) tuples
+    Returns:
+      A list of booleans, in input order.
+    """
+    return [is_valid(hashed_password, password)
+            for hashed_password, password in pairs]
+
+
+def _stream_chunks(function, items: Iterator, workers: int,
+                   chunk_size: int) -> Iterator:
+    """ Apply a chunk function across a process pool, streaming results.
+    Only two chunks per worker are in flight, so the input is consumed
+    lazily and memory stays bounded whatever its length.
+    Arguments:
+      function -- picklable function taking and returning a list
+      items(iterator) -- items to process
+      workers(int) -- number of worker processes
+      chunk_size(int) -- number of items sent to a worker at once
+    Returns:
+      An iterator over the results, in input order.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        while True:
+            chunk = list(islice(items, chunk_size))
+            if chunk:
+                pending.append(executor.submit(function, chunk))
+            if pending and (not chunk or len(pending) >= 2 * workers):
+                yield from pending.popleft().result()
+            if not chunk and not pending:
+                return
+
+
+def _run_chunked(function, items: Iterable, workers: int,
+                 chunk_size: int) -> Iterator:
+    """ Check the pool settings, then stream the results of a chunk function.
+    Arguments:
+      function -- picklable function taking and returning a list
+      items(iterable) -- items to process
+      workers(int) -- number of worker processes, None for os.cpu_count()
+      chunk_size(int) -- number of items sent to a worker at once
+    Returns:
+      An iterator over the results, in input order.
+    """
+    workers = workers or os.cpu_count() or 1
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    return _stream_chunks(function, iter(items), workers, chunk_size)
+
+
+def hash_passwords(passwords: Iterable[str], workers: int = None,
+                   chunk_size: int = HASH_CHUNK_SIZE) -> Iterator[bytes]:
+    """ Hashes many passwords across a pool of processes.
+    Arguments:
+      passwords(iterable) -- strings to be hashed
+      workers(int) -- number of worker processes, os.cpu_count() by default
+      chunk_size(int) -- number of passwords sent to a worker at once
+    Returns:
+      A generator of byte strings, in input order.
+    """
+    # Resolve the cost here, workers don't share the calibrated value
+    hash_chunk = partial(_hash_chunk, cost=get_bcrypt_cost())
+    return _run_chunked(hash_chunk, passwords, workers, chunk_size)
+
+
+def verify_many(pairs: Iterable[Tuple[bytes, str]], workers: int = None,
+                chunk_size: int = HASH_CHUNK_SIZE) -> Iterator[bool]:
+    """ Validates many passwords across a pool of processes.
+    Arguments:
+      pairs(iterable) -- (hashed_password, password) tuples
+      workers(int) -- number of worker processes, os.cpu_count() by default
+      chunk_size(int) -- number of pairs sent to a worker at once
+    Returns:
+      A generator of booleans, in input order.
+    """
+    return _run_chunked(_verify_chunk, pairs, workers, chunk_size)
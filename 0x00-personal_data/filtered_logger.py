@@ -11,64 +11,719 @@ We define a list of fields to redact, PII_FIELDS.
 Contains a get_logger() function that returns a logger object.
 """
 
+import argparse
+import atexit
+import copy
+import csv
+import gzip
+import hashlib
+import hmac
+import json
 import logging
+import logging.handlers
+import queue
+import random
 import re
-from typing import List
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from typing import (Callable, Dict, Iterable, Iterator, List, Optional,
+                    Sequence, TextIO, Tuple)
 import os
 import mysql.connector
+import mysql.connector.pooling
 from mysql.connector import connection
+from mysql.connector.errors import PoolError
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for zstd compressed archives
+    zstandard = None
+# Errors of a failed zstd compression, besides OSError
+ZSTD_ERRORS = (zstandard.ZstdError,) if zstandard is not None else ()
 
 # Define PII_FIELDS constant with fields to be considered as PII
 # Personal Identifiable Information (PII) fields, in other words sensitive
 PII_FIELDS = ('name', 'password', 'email', 'ssn', 'phone')
 
 
+# Upper bound on the number of distinct (fields, redaction, separator)
+# combinations kept compiled at once, so dynamic field sets can't leak memory
+REDACTOR_CACHE_SIZE = 128
+# Upper bound on the number of keys whose verdict a tokenizer remembers
+KEY_CACHE_SIZE = 4096
+# Redaction engines of filter_datum(), 'auto' picks the tokenizer for
+# plain field names and the regex otherwise
+REDACTION_ENGINES = ('auto', 'regex', 'tokenizer')
+# Stands for a value redacted by key while the rest of a structured
+# record is scanned, NUL never shows up in a field name nor a separator
+PLACEHOLDER = '\x00{}\x00'
+PLACEHOLDER_PATTERN = re.compile('\x00([0-9]+)\x00')
+# A `%(key)d` style conversion of a format string with mapping args
+MAPPING_CONVERSION = re.compile(
+    r'%\(([^)]*)\)[#0 +-]*(?:\*|[0-9]+)?(?:\.(?:\*|[0-9]+))?[hlL]?'
+    r'[diouxXeEfFgGcrsa]')
+# Characters that make a field a regex rather than a plain name
+REGEX_SPECIAL_CHARS = frozenset('.^$*+?{}[]\\|()')
+# Pseudonymization tokens: prefix, number of hex digits of the HMAC kept,
+# and number of distinct values whose token is cached
+PSEUDONYM_PREFIX = 'pii_'
+PSEUDONYM_LENGTH = 16
+PSEUDONYM_CACHE_SIZE = 65536
+
+# Overflow policies of the queued logging pipeline, used when the queue
+# between the logging threads and the writer thread is full
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEW = 'drop_new'
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEW)
+# Default number of records the queued logging pipeline can hold
+LOG_QUEUE_SIZE = 10000
+# Duplicate suppression: seconds a repeated message is collapsed for, and
+# number of distinct messages tracked at once
+DEDUP_WINDOW = 1.0
+DEDUP_CACHE_SIZE = 4096
+
+# Rotating log files: size and age that trigger a rotation (0 disables
+# either), number of archives kept and how archives are compressed
+LOG_MAX_BYTES = 100 * 1024 * 1024
+LOG_ROTATE_INTERVAL = 0
+LOG_MAX_ARCHIVES = 10
+LOG_COMPRESSIONS = ('gzip', 'zstd', 'none')
+ARCHIVE_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+# Database backends understood by get_db(), sqlite is a local stand-in
+DB_BACKENDS = ('mysql', 'sqlite')
+# Default number of connections kept by the pool of get_db_pool()
+DB_POOL_SIZE = 5
+
+# Output formats of the export mode and number of rows fetched at once
+EXPORT_FORMATS = ('log', 'ndjson', 'csv')
+EXPORT_BATCH_SIZE = 1000
+# How PII columns are selected: replaced by the redaction in SQL, left out
+# of the SELECT list, or fetched as is and redacted in Python
+PII_COLUMN_MODES = ('mask', 'omit', 'fetch')
+
+
+class Pseudonymizer:
+    """ Pseudonymizer class
+    Replaces PII values with stable keyed-hash tokens instead of a fixed
+    redaction, so the events of one user can still be correlated across
+    log lines without revealing the value. A token is a prefix followed by
+    the first hex digits of the HMAC-SHA256 of the value.
+    The same emails and names come back line after line, tokens are kept
+    in an LRU cache in front of the HMAC and its hits are counted.
+    Example usage:
+        pseudonymizer = Pseudonymizer(key)
+        filter_datum(PII_FIELDS, pseudonymizer, message, ';')
+    """
+
+    def __init__(self, key=None, length: int = PSEUDONYM_LENGTH,
+                 prefix: str = PSEUDONYM_PREFIX,
+                 cache_size: int = PSEUDONYM_CACHE_SIZE):
+        """ Initialize the Pseudonymizer object
+        Arguments:
+          key -- HMAC secret, as str or bytes, PERSONAL_DATA_PSEUDONYM_KEY
+                 by default; without either a random key is drawn and the
+                 tokens are only stable within this process
+          length -- number of hex digits of the HMAC kept in a token
+          prefix -- string put in front of every token
+          cache_size -- number of distinct values whose token is cached
+        """
+        if key is None:
+            key = os.getenv('PERSONAL_DATA_PSEUDONYM_KEY') or os.urandom(32)
+        if isinstance(key, str):
+            key = key.encode()
+        if not 0 < length <= 2 * hashlib.sha256().digest_size:
+            raise ValueError("length must be between 1 and 64")
+        self._key = key
+        self.length = length
+        self.prefix = prefix
+        self.token = lru_cache(maxsize=cache_size)(self._token)
+
+    def _token(self, value: str) -> str:
+        """ Compute the token of a value, uncached
+        Arguments:
+          value -- PII value to pseudonymize
+        Returns:
+        The token of the value.
+        """
+        digest = hmac.digest(
+            self._key, value.encode('utf-8', 'surrogateescape'), 'sha256')
+        return self.prefix + digest.hex()[:self.length]
+
+    def __call__(self, value: str) -> str:
+        """ Get the token of a value, from the cache when possible
+        Arguments:
+          value -- PII value to pseudonymize
+        Returns:
+        The token of the value.
+        """
+        return self.token(value)
+
+    def cache_info(self):
+        """ Counters of the token cache
+        Returns:
+        A named tuple (hits, misses, maxsize, currsize).
+        """
+        return self.token.cache_info()
+
+    @property
+    def hit_rate(self) -> float:
+        """ Share of the tokens served from the cache, 0.0 before any
+        """
+        info = self.token.cache_info()
+        lookups = info.hits + info.misses
+        return info.hits / lookups if lookups else 0.0
+
+    def clear_cache(self):
+        """ Empty the token cache and reset its counters
+        """
+        self.token.cache_clear()
+
+
+@lru_cache(maxsize=REDACTOR_CACHE_SIZE)
+def _compile_redactor(fields: Tuple[str, ...], redaction,
+                      separator: str) -> Callable[[str], str]:
+    """
+    Build the redaction function for a set of fields.
+    The pattern is compiled once per (fields, redaction, separator) and the
+    field name is carried by a capture group, so matches are rewritten by
+    the regex engine itself instead of being split in Python.
+    Arguments:
+      fields -- tuple of strings representing fields to obfuscate
+      redaction -- string to replace field values with, or a function
+                   mapping a value to its replacement
+      separator -- character separating fields in the log line
+    Returns:
+    A function taking a log line and returning the obfuscated line.
+    """
+    if not fields:
+        # Nothing to redact, the message is returned untouched
+        return str
+    pattern = re.compile('({})=[^{}]*'.format('|'.join(fields), separator))
+    if callable(redaction):
+        def replace(match) -> str:
+            """ Swap the value of a match for its replacement """
+            key = match.group(1)
+            return key + '=' + redaction(match.group(0)[len(key) + 1:])
+        return partial(pattern.sub, replace)
+    # Escape backslashes so the redaction string is inserted literally
+    replacement = r'\g<1>=' + redaction.replace('\\', r'\\')
+    return partial(pattern.sub, replacement)
+
+
 def filter_datum(fields: List[str],
-                 redaction: str, message: str, separator: str) -> str:
+                 redaction: str, message: str, separator: str,
+                 engine: str = 'auto') -> str:
     """
     Filter sensitive data in a message.
     Arguments:
       fields -- list of strings representing fields to obfuscate
-      redaction -- string to replace field values with
+      redaction -- string to replace field values with, or a Pseudonymizer
+                   to replace them with stable tokens
       message -- log line string
       separator -- character separating fields in the log line
+      engine -- one of REDACTION_ENGINES, they all give the same output
     Returns:
     The obfuscated log message.
     """
-    # Create a regular expression pattern to match the fields to be redacted
-    pattern = '|'.join(f'{field}=[^{separator}]*' for field in fields)
+    # Fetch (or build once) the compiled redactor for these fields
+    redact = _select_redactor(tuple(fields), redaction, separator, engine)
+    return redact(message)
+
+
+@lru_cache(maxsize=REDACTOR_CACHE_SIZE)
+def _compile_key_matcher(fields: Tuple[str, ...]) -> Callable[[str], bool]:
+    """
+    Build a predicate telling whether a key is redacted by filter_datum.
+    filter_datum redacts `key=` whenever a field is a suffix of the key
+    (e.g. `name` also matches ` first_name`), so the key is looked up in
+    a set once per distinct field length instead of scanning every field.
+    Arguments:
+      fields -- tuple of strings representing fields to obfuscate
+    Returns:
+    A function taking a key and returning True if its value is redacted.
+    """
+    field_set = frozenset(fields)
+    if '' in field_set:
+        # An empty field name matches in front of every `=`
+        return lambda key: True
+    lengths = sorted({len(field) for field in field_set})
+
+    def matches(key: str) -> bool:
+        """ Check whether the key ends with one of the fields """
+        if key in field_set:
+            return True
+        for length in lengths:
+            if length >= len(key):
+                break
+            if key[-length:] in field_set:
+                return True
+        return False
+    return matches
+
+
+@lru_cache(maxsize=REDACTOR_CACHE_SIZE)
+def _compile_tokenizer(fields: Tuple[str, ...], redaction,
+                       separator: str) -> Callable[[str], str]:
+    """
+    Build a single-pass redaction function for `key=value<sep>` lines.
+    Each line is split once on the separator and a value is swapped for
+    the redaction when the text before one of its `=` ends with a field,
+    which is exactly what the filter_datum pattern matches.
+    Arguments:
+      fields -- tuple of strings representing fields to obfuscate
+      redaction -- string to replace field values with
+      separator -- character separating fields in the log line
+    Returns:
+    A function taking a log line and returning the obfuscated line.
+    """
+    if not fields or len(separator) != 1 or any(
+            separator in field or '=' in field for field in fields):
+        # The regex treats a longer separator as a character class and
+        # such fields can span tokens, defer to it to keep the same output
+        return _compile_redactor(fields, redaction, separator)
+    matches = _compile_key_matcher(fields)
+    pseudonymize = callable(redaction)
+    # Column names repeat from one line to the next, remember the verdict
+    # for each key seen (bounded, free-form keys are not)
+    known = {}
+
+    def redact(message: str) -> str:
+        """ Obfuscate the configured fields in a single log line """
+        if '=' not in message:
+            return message
+        segments = message.split(separator)
+        for index, segment in enumerate(segments):
+            key, equal, value = segment.partition('=')
+            if not equal:
+                continue
+            hit = known.get(key)
+            if hit is None:
+                if len(known) >= KEY_CACHE_SIZE:
+                    known.clear()
+                hit = known[key] = matches(key)
+            if hit:
+                segments[index] = key + '=' + (
+                    redaction(value) if pseudonymize else redaction)
+            elif '=' in value:
+                # The regex also matches a field in front of a later `=`
+                start = len(key) + 1
+                equal = segment.find('=', start)
+                while equal != -1:
+                    if matches(segment[start:equal]):
+                        segments[index] = segment[:equal + 1] + (
+                            redaction(segment[equal + 1:]) if pseudonymize
+                            else redaction)
+                        break
+                    start = equal + 1
+                    equal = segment.find('=', start)
+        return separator.join(segments)
+    return redact
+
+
+@lru_cache(maxsize=REDACTOR_CACHE_SIZE)
+def _select_redactor(fields: Tuple[str, ...], redaction,
+                     separator: str, engine: str = 'auto') -> \
+        Callable[[str], str]:
+    """
+    Get the compiled redaction function of an engine, memoized so the
+    'auto' decision isn't taken again on every line.
+    With 'auto', plain field names go to the tokenizer, which is faster
+    than the regex at any list size, and regexes go to the regex.
+    Arguments:
+      fields -- tuple of strings representing fields to obfuscate
+      redaction -- string to replace field values with
+      separator -- character separating fields in the log line
+      engine -- one of REDACTION_ENGINES
+    Returns:
+    A function taking a log line and returning the obfuscated line.
+    """
+    if isinstance(redaction, Pseudonymizer):
+        # Call the cached token function directly, skipping __call__
+        redaction = redaction.token
+    if engine == 'auto':
+        plain = not any(REGEX_SPECIAL_CHARS.intersection(field)
+                        for field in fields)
+        engine = 'tokenizer' if plain else 'regex'
+    if engine == 'regex':
+        return _compile_redactor(fields, redaction, separator)
+    if engine == 'tokenizer':
+        return _compile_tokenizer(fields, redaction, separator)
+    raise ValueError("engine must be one of {}".format(
+        ", ".join(REDACTION_ENGINES)))
+
+
+def filter_datum_batch(fields: List[str], redaction: str,
+                       messages: Iterable[str], separator: str) -> List[str]:
+    """
+    Filter sensitive data in many messages at once.
+    The redactor is looked up once for the whole batch, the output of each
+    line is identical to filter_datum().
+    Arguments:
+      fields -- list of strings representing fields to obfuscate
+      redaction -- string to replace field values with, or a Pseudonymizer
+      messages -- list or iterable of log line strings
+      separator -- character separating fields in the log line
+    Returns:
+    The list of obfuscated log messages, in input order.
+    """
+    redact = _select_redactor(tuple(fields), redaction, separator)
+    return list(map(redact, messages))
+
 
-    # Use the re.sub() function to replace the matched fields
-    # with the redaction string
-    # The lambda function is used to split the matched field and replace only
-    # the value with the redaction string
-    filtered_data = re.sub(
-        pattern, lambda m: f"{m.group().split('=')[0]}={redaction}", message)
-    return filtered_data
+def _decode_redactor(fields: Tuple[str, ...], redaction, separator: str,
+                     multiline: bool) -> Callable:
+    """
+    Build a bytes redaction function going through the str path.
+    Used when a bytes pattern could disagree with filter_datum(): for a
+    separator that is not one ASCII character, or for regex fields, whose
+    classes such as \\w only match ASCII in a bytes pattern.
+    Arguments:
+      fields -- tuple of strings representing fields to obfuscate
+      redaction -- string to replace field values with, or a function
+      separator -- character separating fields in the log line
+      multiline -- the input holds several newline separated lines
+    Returns:
+    A function taking bytes and an output bytearray, see
+    _compile_bytes_redactor().
+    """
+    redact = _compile_redactor(fields, redaction, separator)
+
+    def redact_decoded(data, out: bytearray) -> bytearray:
+        """ Decode, redact like filter_datum() and encode back """
+        text = bytes(data).decode('utf-8', 'surrogateescape')
+        if multiline:
+            text = '\n'.join(map(redact, text.split('\n')))
+        else:
+            text = redact(text)
+        out += text.encode('utf-8', 'surrogateescape')
+        return out
+    return redact_decoded
+
+
+@lru_cache(maxsize=REDACTOR_CACHE_SIZE)
+def _compile_bytes_redactor(fields: Tuple[str, ...], redaction,
+                            separator: str, multiline: bool = False) -> \
+        Callable:
+    """
+    Build a redaction function working on bytes.
+    The pattern matches the `=` of a key ending with a field, checked by
+    one look-behind per field, and the value after it. The replacement is
+    then a constant, so the regex engine rewrites the whole input without
+    calling back into Python. UTF-8 never uses ASCII byte values inside a
+    multi-byte character, so an ASCII separator splits the bytes exactly
+    where it splits the decoded text.
+    Arguments:
+      fields -- tuple of strings representing fields to obfuscate
+      redaction -- string to replace field values with, or a function
+                   mapping a value to its replacement
+      separator -- character separating fields in the log line
+      multiline -- the input holds several newline separated lines, a
+                   value then also stops at the end of its line
+    Returns:
+    A function taking bytes or a memoryview and a bytearray, appending
+    the obfuscated input to the bytearray and returning it.
+    """
+    if len(separator) != 1 or not separator.isascii() or any(
+            REGEX_SPECIAL_CHARS.intersection(field) or '=' in field or
+            separator in field or '\n' in field for field in fields):
+        # A match could then start inside the value of the previous one
+        return _decode_redactor(fields, redaction, separator, multiline)
+    if not fields:
+        def copy(data, out: bytearray) -> bytearray:
+            """ Nothing to redact, copy the input as is """
+            out += data
+            return out
+        return copy
+    pattern = re.compile('=(?:{})[^{}]*'.format(
+        '|'.join('(?<={}=)'.format(field) for field in dict.fromkeys(fields)),
+        separator).encode())
+
+    if callable(redaction):
+        def replace(match) -> bytes:
+            """ Swap the value of a match for its replacement """
+            value = match.group(0)[1:].decode('utf-8', 'surrogateescape')
+            return b'=' + redaction(value).encode('utf-8', 'surrogateescape')
+    else:
+        # Escape backslashes so the redaction is inserted literally
+        replace = b'=' + redaction.encode(
+            'utf-8', 'surrogateescape').replace(b'\\', b'\\\\')
+    sub = partial(pattern.sub, replace)
+
+    if multiline:
+        def redact_lines(data, out: bytearray) -> bytearray:
+            """ Append the obfuscated lines to the output buffer """
+            # Splitting is faster than a [^sep\n] class in the pattern. A
+            # memoryview has no split(), bytes() copies it once, and the
+            # lines are copies anyway
+            out += b'\n'.join(map(sub, bytes(data).split(b'\n')))
+            return out
+        return redact_lines
+
+    def redact(data, out: bytearray) -> bytearray:
+        """ Append the obfuscated input to the output buffer """
+        out += sub(data)
+        return out
+    return redact
+
+
+def filter_datum_bytes(fields: List[str], redaction, message,
+                       separator: str,
+                       out: Optional[bytearray] = None) -> bytearray:
+    """
+    Filter sensitive data in a log line given as bytes.
+    The result is the UTF-8 encoding of what filter_datum() gives for the
+    decoded line, without decoding nor encoding it.
+    Arguments:
+      fields -- list of strings representing fields to obfuscate
+      redaction -- string to replace field values with, or a Pseudonymizer
+      message -- log line as bytes, bytearray or memoryview
+      separator -- character separating fields in the log line
+      out -- buffer the obfuscated line is appended to, reuse it (after
+             clearing it) across calls to save allocations
+    Returns:
+    The output buffer.
+    """
+    if isinstance(redaction, Pseudonymizer):
+        redaction = redaction.token
+    redact = _compile_bytes_redactor(tuple(fields), redaction, separator)
+    return redact(message, bytearray() if out is None else out)
+
+
+def filter_lines_bytes(fields: List[str], redaction, data, separator: str,
+                       out: Optional[bytearray] = None) -> bytearray:
+    """
+    Filter sensitive data in a block of newline separated log lines.
+    The block is split and joined without a Python loop, each line is
+    obfuscated like filter_datum_bytes() would. A memoryview is copied
+    once before being split.
+    Arguments:
+      fields -- list of strings representing fields to obfuscate
+      redaction -- string to replace field values with, or a Pseudonymizer
+      data -- log lines as bytes, bytearray or memoryview
+      separator -- character separating fields in the log line
+      out -- buffer the obfuscated lines are appended to
+    Returns:
+    The output buffer.
+    """
+    if isinstance(redaction, Pseudonymizer):
+        redaction = redaction.token
+    redact = _compile_bytes_redactor(tuple(fields), redaction, separator,
+                                     multiline=True)
+    return redact(data, bytearray() if out is None else out)
 
 
 class RedactingFormatter(logging.Formatter):
     """ Redacting Formatter class
     This class will redact sensitive data from log messages.
+    Structured records are redacted by key before formatting, they carry
+    their data either as mapping args or as a `fields` dict:
+        logger.info("login %(email)s", {"email": email})
+        logger.info("login", extra={"fields": {"email": email}})
+    Other records are free-form and their formatted text is scanned.
+    With a Pseudonymizer, values are replaced by their stable token
+    instead of REDACTION.
     """
 
     REDACTION = "***"
     FORMAT = "[HOLBERTON] %(name)s %(levelname)s %(asctime)-15s: %(message)s"
     SEPARATOR = ";"
 
-    def __init__(self, fields: List[str]):
+    def __init__(self, fields: List[str],
+                 pseudonymizer: Optional[Pseudonymizer] = None):
         """ Initialize the RedactingFormatter object
         Arguments:
           fields -- list of strings representing fields to obfuscate
+          pseudonymizer -- replace values with its tokens, not REDACTION
         """
         super(RedactingFormatter, self).__init__(self.FORMAT)
         # Initialize the fields attribute with the provided list of fields
         self.fields = fields if fields is not None else []
+        self.pseudonymizer = pseudonymizer
+        # Resolve the compiled redactor once instead of on every record
+        self._redact = _select_redactor(
+            tuple(self.fields), pseudonymizer or self.REDACTION,
+            self.SEPARATOR)
+        # Scan of structured records, which keeps their placeholders
+        self._scan_redact = _select_redactor(
+            tuple(self.fields), self._scan_value, self.SEPARATOR)
+        self._matches = _compile_key_matcher(tuple(self.fields))
+        self._verdicts = {}
+
+    def _is_redacted(self, key) -> bool:
+        """ Tell whether the value of a key is redacted, memoized per key
+        Arguments:
+          key -- key of a structured record
+        Returns:
+        True if the key is matched by one of the fields.
+        """
+        verdicts = self._verdicts
+        hit = verdicts.get(key)
+        if hit is None:
+            if len(verdicts) >= KEY_CACHE_SIZE:
+                verdicts.clear()
+            hit = verdicts[key] = self._matches(str(key))
+        return hit
+
+    def redact_mapping(self, data: Mapping) -> dict:
+        """ Redact the values of a mapping by key
+        Keys are matched like the keys of a log line by filter_datum().
+        Arguments:
+          data -- mapping of keys to values
+        Returns:
+        A new dict with the values of the matched keys redacted.
+        """
+        is_redacted = self._is_redacted
+        if self.pseudonymizer is not None:
+            token = self.pseudonymizer.token
+            return {key: token(str(value)) if is_redacted(key) else value
+                    for key, value in data.items()}
+        redaction = self.REDACTION
+        return {key: redaction if is_redacted(key) else value
+                for key, value in data.items()}
+
+    def _placeholders(self, data: Mapping, values: list) -> dict:
+        """ Swap the values of the matched keys for placeholders
+        Arguments:
+          data -- mapping of keys to values
+          values -- list the swapped values are appended to, a placeholder
+                    holds the index of its value
+        Returns:
+        A new dict with the values of the matched keys replaced.
+        """
+        is_redacted = self._is_redacted
+        placeholders = {}
+        for key, value in data.items():
+            if is_redacted(key):
+                placeholders[key] = PLACEHOLDER.format(len(values))
+                values.append(value)
+            else:
+                placeholders[key] = value
+        return placeholders
+
+    def _scan_value(self, value: str) -> str:
+        """ Redact a value found by the scan, placeholders are kept
+        Arguments:
+          value -- value of a matched field in the text
+        Returns:
+        The value as is if it is a placeholder, else its redaction.
+        """
+        if PLACEHOLDER_PATTERN.fullmatch(value):
+            return value
+        return self._redact_value(value)
+
+    def _redact_value(self, value) -> str:
+        """ Redaction of one value: its token, or REDACTION
+        """
+        if self.pseudonymizer is not None:
+            return self.pseudonymizer.token(str(value))
+        return self.REDACTION
+
+    def _scan(self, message: str, values: list) -> str:
+        """ Scan a message holding placeholders like a free-form one
+        The placeholders are then replaced by the redaction of their
+        value, so no value is pseudonymized twice.
+        Arguments:
+          message -- message built with _placeholders()
+          values -- values of its placeholders
+        Returns:
+        The redacted message.
+        """
+        message = self._scan_redact(message)
+        redacted = [self._redact_value(value) for value in values]
+
+        def replace(match) -> str:
+            """ Put the redaction of its value in place of a placeholder """
+            index = int(match.group(1))
+            if index < len(redacted):
+                return redacted[index]
+            # Not ours, it came with the record: redact it as a value
+            return self._redact_value(match.group(0))
+        return PLACEHOLDER_PATTERN.sub(replace, message)
+
+    def _build_message(self, record: logging.LogRecord,
+                       fields: Optional[Mapping],
+                       redact_mapping: Callable[[Mapping], dict]) -> \
+            Tuple[str, bool]:
+        """ Merge the args and the fields of a structured record
+        Arguments:
+          record -- log record to format
+          fields -- its `fields` dict, if any
+          redact_mapping -- replaces the values of the matched keys
+        Returns:
+        The message, and whether a value not replaced, or the format
+        string, holds an equal sign. Replaced values never do.
+        Raises what the format string raises with the args.
+        """
+        message = str(record.msg)
+        free_text = '=' in message
+        if isinstance(record.args, Mapping):
+            args = redact_mapping(record.args)
+            try:
+                message = message % args
+            except (TypeError, ValueError):
+                # A redacted value given to `%(key)d`, print it with %s
+                message = MAPPING_CONVERSION.sub(
+                    lambda match: "%({})s".format(match.group(1))
+                    if self._is_redacted(match.group(1))
+                    else match.group(0), message) % args
+            free_text = free_text or '=' in message
+        if fields:
+            separator = self.SEPARATOR
+            pairs = "".join([f"{key}={value}{separator}" for key, value
+                             in redact_mapping(fields).items()])
+            free_text = free_text or pairs.count('=') != len(fields)
+            message = "{} {}".format(message, pairs) if message else pairs
+        return message, free_text
+
+    def structured_message(self, record: logging.LogRecord) -> \
+            Optional[str]:
+        """ Build the redacted message of a structured record
+        Mapping args are redacted before being merged into the message,
+        the `fields` dict is appended as `key=value;` pairs. If the format
+        string or a value not redacted by key holds an equal sign, the
+        message is also scanned like a free-form one, before the redacted
+        values are put in.
+        Arguments:
+          record -- log record to format
+        Returns:
+        The redacted message, or None for a free-form record or one
+        whose message can't be formatted.
+        """
+        fields = getattr(record, 'fields', None)
+        if not isinstance(fields, Mapping):
+            fields = None
+        if fields is None and not isinstance(record.args, Mapping):
+            return None
+
+        try:
+            message, free_text = self._build_message(
+                record, fields, self.redact_mapping)
+        except (TypeError, ValueError, KeyError):
+            # Broken format string or args: the free-form path formats
+            # the record again, and its handler reports the error
+            return None
+        if not free_text:
+            return message
+        values = []
+        message, _ = self._build_message(
+            record, fields, partial(self._placeholders, values=values))
+        return self._scan(message, values)
 
     def format(self, record: logging.LogRecord) -> str:
         """ Format the log record
-        By first calling the format() method of the parent class, we can
-        obtain the original log message.
+        Structured records are redacted by key and formatted directly.
+        For free-form records, by first calling the format() method of the
+        parent class, we can obtain the original log message.
         We then call the filter_datum() function to obfuscate the sensitive
         data in the log message.
         Arguments:
@@ -76,14 +731,608 @@ class RedactingFormatter(logging.Formatter):
         Returns:
         The formatted log message.
         """
+        message = self.structured_message(record)
+        if message is not None:
+            record.message = message
+            if self.usesTime():
+                record.asctime = self.formatTime(record, self.datefmt)
+            formatted = self.formatMessage(record)
+            if not (record.exc_info or record.exc_text or record.stack_info):
+                return formatted
+            # Tracebacks are free-form text, they still have to be scanned
+            if record.exc_info and not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+            trace = []
+            if record.exc_text:
+                trace.append(record.exc_text)
+            if record.stack_info:
+                trace.append(self.formatStack(record.stack_info))
+            return "{}\n{}".format(
+                formatted, self._redact("\n".join(trace)))
+
         original_message = super(RedactingFormatter, self).format(record)
-        filtered_data = filter_datum(
-            self.fields, self.REDACTION, original_message, self.SEPARATOR)
+        filtered_data = self._redact(original_message)
         return filtered_data
 
 
-def get_logger() -> logging.Logger:
+# Pieces of a JSON document: a string, a key (string followed by its
+# colon), the text up to the next key or bracket with the string values
+# in it skipped whole, a literal value, and a string or bracket
+JSON_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+JSON_NEXT_KEY = re.compile(
+    r'(?:[^"]|"[^"\\]*(?:\\.[^"\\]*)*"(?!\s*:))*'
+    r'("[^"\\]*(?:\\.[^"\\]*)*")\s*:')
+JSON_NEXT_KEY_OR_BRACKET = re.compile(
+    r'(?:[^"{}\[\]]|"[^"\\]*(?:\\.[^"\\]*)*"(?!\s*:))*'
+    r'(?:("[^"\\]*(?:\\.[^"\\]*)*")\s*:|([{}\[\]]))')
+JSON_LITERAL = re.compile(r'[^\s,}\]]*')
+JSON_TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]]')
+
+
+def _json_value_span(document: str, position: int) -> Tuple[int, int]:
+    """
+    Find the value that starts after a key of a JSON document.
+    Arguments:
+      document -- JSON text
+      position -- offset right after the colon of the key
+    Returns:
+    The (start, end) offsets of the value, containers included.
+    """
+    length = len(document)
+    while position < length and document[position] in ' \t\r\n':
+        position += 1
+    if position == length:
+        return position, position
+    char = document[position]
+    if char == '"':
+        match = JSON_STRING.match(document, position)
+        return position, match.end() if match else length
+    if char not in '{[':
+        return position, JSON_LITERAL.match(document, position).end()
+    depth = 0
+    for token in JSON_TOKEN.finditer(document, position):
+        char = document[token.start()]
+        if char in '{[':
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+            if not depth:
+                return position, token.end()
+    return position, length
+
+
+@lru_cache(maxsize=REDACTOR_CACHE_SIZE)
+def _compile_json_redactor(fields: Tuple[str, ...],
+                           redaction: str) -> Callable[[str], str]:
+    """
+    Build a redaction function for JSON documents.
+    The document is walked once, key by key, and the value of a key is
+    masked when the key or its dotted path is one of the fields, whatever
+    its type. The rest of the document is copied as is. Strings are
+    skipped whole, so a key quoted inside a string value is never taken
+    for a real key. Brackets are only tracked when a field is a path.
+    Arguments:
+      fields -- tuple of keys or dotted key paths to obfuscate
+      redaction -- string to replace values with
+    Returns:
+    A function taking a JSON document and returning it obfuscated.
+    """
+    field_set = frozenset(fields)
+    masked = json.dumps(redaction)
+    with_paths = any('.' in field for field in fields)
+    # A document can only match if the last part of a field is quoted in
+    # it, unless keys hide behind \u escapes
+    leaves = tuple({'"{}"'.format(field.rsplit('.', 1)[-1])
+                    for field in fields})
+    next_token = (JSON_NEXT_KEY_OR_BRACKET if with_paths
+                  else JSON_NEXT_KEY).match
+
+    def redact(document: str) -> str:
+        """ Obfuscate the configured keys of a single JSON document """
+        if '\\u' not in document and \
+                not any(leaf in document for leaf in leaves):
+            return document
+        parts = []
+        copied = position = 0
+        stack = []          # path of every open container
+        value_path = None   # path of the value that comes next
+
+        while True:
+            token = next_token(document, position)
+            if token is None:
+                break
+            position = token.end()
+            key = token.group(1)
+            if key is None:
+                # A bracket, only matched when fields are paths
+                if token.group(2) in '{[':
+                    if value_path is None:
+                        # Array items share the path of their array
+                        value_path = stack[-1] if stack else ''
+                    stack.append(value_path)
+                elif stack:
+                    stack.pop()
+                value_path = None
+                continue
+
+            key = json.loads(key) if '\\' in key else key[1:-1]
+            path = key
+            if with_paths and stack and stack[-1]:
+                path = '{}.{}'.format(stack[-1], key)
+            if key in field_set or path in field_set:
+                start, position = _json_value_span(document, position)
+                parts += [document[copied:start], masked]
+                copied = position
+                value_path = None
+            else:
+                value_path = path
+        parts.append(document[copied:])
+        return ''.join(parts)
+    return redact
+
+
+def filter_json(fields: List[str], redaction: str, document: str) -> str:
+    """
+    Filter sensitive data in a JSON document.
+    Arguments:
+      fields -- list of keys or dotted key paths (e.g. `user.email`) to
+                obfuscate, array items share the path of their array
+      redaction -- string to replace values with
+      document -- JSON text, the formatting is kept as is
+    Returns:
+    The obfuscated JSON document.
+    """
+    redact = _compile_json_redactor(tuple(fields), redaction)
+    return redact(document)
+
+
+def filter_ndjson(fields: List[str], lines: Iterable[str],
+                  redaction: str = None) -> Iterator[str]:
+    """
+    Filter sensitive data in a stream of NDJSON lines.
+    Lines are processed one at a time, so an open file can be streamed.
+    Arguments:
+      fields -- list of keys or dotted key paths to obfuscate
+      lines -- iterable of JSON documents, one per line
+      redaction -- string to replace values with,
+                   RedactingFormatter.REDACTION by default
+    Returns:
+    An iterator of obfuscated lines, in input order.
+    """
+    if redaction is None:
+        redaction = RedactingFormatter.REDACTION
+    return map(_compile_json_redactor(tuple(fields), redaction), lines)
+
+
+class RedactingQueueListener(logging.handlers.QueueListener):
+    """ Queue listener for the queued logging pipeline
+    The sentinel is enqueued with a blocking put, so stopping the listener
+    waits for room in a full bounded queue instead of raising.
+    """
+
+    def enqueue_sentinel(self):
+        """ Ask the listener thread to stop once the queue is drained
+        """
+        self.queue.put(self._sentinel)
+
+
+# Live DedupSamplingFilter objects, their pending summaries are emitted
+# at exit
+_dedup_filters = weakref.WeakSet()
+
+
+def _flush_dedup_filters():
+    """ Emit the pending summaries of every DedupSamplingFilter
+    Registered after logging's own exit handler, so it runs first.
+    """
+    for log_filter in list(_dedup_filters):
+        log_filter.flush()
+
+
+atexit.register(_flush_dedup_filters)
+
+
+class DedupSamplingFilter(logging.Filter):
+    """ Duplicate suppression and sampling filter
+    Installed on the logger, it runs before any handler, so dropped
+    records are never formatted nor redacted.
+    Records of a level are kept with the probability given by its sample
+    rate. A message repeated within the window is then passed once, its
+    repeats are counted and reported by a summary record,
+    `<message> [repeated N times]`. The summary is emitted by the first
+    record logged after the window is over, by flush(), or at the exit
+    of the interpreter, before the handlers are closed.
+    """
+
+    def __init__(self, window: float = DEDUP_WINDOW,
+                 sample_rates: Optional[Mapping] = None,
+                 max_messages: int = DEDUP_CACHE_SIZE):
+        """ Initialize the DedupSamplingFilter object
+        Arguments:
+          window -- seconds during which repeats of a message are
+                    collapsed, 0 disables duplicate suppression
+          sample_rates -- mapping of levels to the share of their records
+                          kept, from 0.0 to 1.0, missing levels keep all
+          max_messages -- number of distinct messages tracked at once
+        """
+        super(DedupSamplingFilter, self).__init__()
+        self.window = window
+        self.sample_rates = dict(sample_rates or {})
+        for level, rate in self.sample_rates.items():
+            if not 0.0 <= rate <= 1.0:
+                raise ValueError("sample rate of level {} must be between "
+                                 "0 and 1".format(level))
+        self.max_messages = max_messages
+        # Message key -> [window start, repeats, first record]
+        self._seen = {}
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+        # Counters of the records dropped by each mechanism
+        self.sampled_out = 0
+        self.suppressed = 0
+        _dedup_filters.add(self)
+
+    @staticmethod
+    def _key(record: logging.LogRecord) -> tuple:
+        """ Identify the message of a record, before any redaction
+        Raises what record.getMessage() raises on bad format args.
+        Arguments:
+          record -- log record to identify
+        Returns:
+        A hashable key, equal for records giving the same line.
+        """
+        fields = getattr(record, 'fields', None)
+        return (record.name, record.levelno, record.getMessage(),
+                repr(fields) if fields is not None else None)
+
+    def _expired(self, now: float, force: bool = False) -> list:
+        """ Remove the messages whose window is over, lock held
+        Arguments:
+          now -- current time
+          force -- remove every message
+        Returns:
+        The summary records of the removed messages that were repeated.
+        """
+        summaries = []
+        for key, (start, repeats, record) in list(self._seen.items()):
+            if force or now - start >= self.window:
+                del self._seen[key]
+                if repeats:
+                    summaries.append(self._summary(record, repeats))
+        self._last_sweep = now
+        return summaries
+
+    @staticmethod
+    def _summary(record: logging.LogRecord,
+                 repeats: int) -> logging.LogRecord:
+        """ Build the record reporting the repeats of a message
+        Arguments:
+          record -- first record of the message
+          repeats -- number of records suppressed after it
+        Returns:
+        A copy of the record with the repeat count appended.
+        """
+        summary = copy.copy(record)
+        summary.msg = "{} [repeated {} times]".format(record.msg, repeats)
+        summary.dedup_summary = True
+        return summary
+
+    def _emit(self, summaries: list):
+        """ Send summary records through their logger
+        Arguments:
+          summaries -- records built by _summary()
+        """
+        for summary in summaries:
+            logging.getLogger(summary.name).handle(summary)
+
+    def flush(self):
+        """ Emit the summaries of every pending repeated message
+        """
+        with self._lock:
+            summaries = self._expired(time.time(), force=True)
+        self._emit(summaries)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """ Decide whether a record is logged
+        Arguments:
+          record -- log record to check
+        Returns:
+        False if the record is sampled out or a repeat, True otherwise.
+        """
+        if getattr(record, 'dedup_summary', False):
+            return True
+        rate = self.sample_rates.get(record.levelno)
+        if rate is not None and rate < 1.0 and random.random() >= rate:
+            self.sampled_out += 1
+            return False
+        if not self.window:
+            return True
+
+        try:
+            key = self._key(record)
+        except Exception:
+            # Bad format args: pass the record, its handler reports them
+            return True
+        now = record.created
+        summaries = []
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is not None and now - entry[0] < self.window:
+                entry[1] += 1
+                self.suppressed += 1
+                return False
+            if entry is not None:
+                # The window is over: report the repeats before this one
+                del self._seen[key]
+                if entry[1]:
+                    summaries.append(self._summary(entry[2], entry[1]))
+            if now - self._last_sweep >= self.window:
+                summaries.extend(self._expired(now))
+            if len(self._seen) >= self.max_messages:
+                summaries.extend(self._expired(now, force=True))
+            self._seen[key] = [now, 0, record]
+        self._emit(summaries)
+        return True
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """ Bounded Queue Handler class
+    This handler only pushes records on a bounded queue, redaction and
+    I/O happen on the thread of its RedactingQueueListener.
+    When the queue is full, the overflow policy decides what happens.
+    """
+
+    def __init__(self, queue_size: int = LOG_QUEUE_SIZE,
+                 overflow: str = OVERFLOW_BLOCK):
+        """ Initialize the BoundedQueueHandler object
+        Arguments:
+          queue_size -- maximum number of records waiting in the queue
+          overflow -- one of OVERFLOW_POLICIES
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of {}".format(
+                ", ".join(OVERFLOW_POLICIES)))
+        super(BoundedQueueHandler, self).__init__(queue.Queue(queue_size))
+        self.overflow = overflow
+        # Counters of records lost to the overflow policy
+        self.dropped_new = 0
+        self.dropped_oldest = 0
+        self.listener = None
+
+    @property
+    def dropped(self) -> int:
+        """ Total number of records dropped because the queue was full
+        """
+        return self.dropped_new + self.dropped_oldest
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """ Prepare a record for the queue
+        Records with mapping args keep them, so RedactingFormatter can
+        still redact them by key on the listener thread.
+        Arguments:
+          record -- log record to prepare
+        Returns:
+        The record to enqueue.
+        """
+        if isinstance(record.args, Mapping) and not record.exc_info:
+            record = copy.copy(record)
+            # Snapshot the args, the caller may mutate them afterwards
+            record.args = dict(record.args)
+            return record
+        return super(BoundedQueueHandler, self).prepare(record)
+
+    def enqueue(self, record: logging.LogRecord):
+        """ Push a record on the queue according to the overflow policy
+        Called with the handler lock held, so the counters are safe. The
+        stop sentinel of the listener is never discarded.
+        Arguments:
+          record -- log record to enqueue
+        """
+        if self.overflow == OVERFLOW_BLOCK:
+            self.queue.put(record)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                if self.overflow == OVERFLOW_DROP_NEW:
+                    self.dropped_new += 1
+                    return
+            # Make room by discarding the oldest waiting record
+            try:
+                oldest = self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            if oldest is RedactingQueueListener._sentinel:
+                # The listener is stopping: keep its sentinel, drop this
+                # record instead, or the listener would never stop
+                self.queue.put(oldest)
+                self.dropped_new += 1
+                return
+            self.dropped_oldest += 1
+
+    def close(self):
+        """ Stop the listener, flushing the queued records, then close
+        """
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+            # The handlers behind the queue may hold files, close them too
+            for handler in listener.handlers:
+                handler.close()
+        super(BoundedQueueHandler, self).close()
+
+
+class CompressingRotatingFileHandler(logging.handlers.BaseRotatingHandler):
+    """ Compressing Rotating File Handler class
+    Writes to a file rotated by size, by age or both. A rotated file is
+    renamed to `<file>.<timestamp>` and compressed on a background thread
+    to `<file>.<timestamp>.gz` (or .zst), so logging never waits for the
+    compression. Only the max_archives most recent archives are kept.
+    Pair it with a RedactingFormatter like any other handler.
+    """
+
+    def __init__(self, filename: str, max_bytes: int = LOG_MAX_BYTES,
+                 interval: float = LOG_ROTATE_INTERVAL,
+                 max_archives: int = LOG_MAX_ARCHIVES,
+                 compression: str = 'gzip', encoding: str = 'utf-8'):
+        """ Initialize the CompressingRotatingFileHandler object
+        Arguments:
+          filename -- path of the log file
+          max_bytes -- rotate once the file has reached this size
+          interval -- rotate once the file is this many seconds old
+          max_archives -- number of rotated files kept, 0 keeps them all
+          compression -- one of LOG_COMPRESSIONS
+          encoding -- encoding of the log file
+        """
+        if compression not in LOG_COMPRESSIONS:
+            raise ValueError("compression must be one of {}".format(
+                ", ".join(LOG_COMPRESSIONS)))
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        super(CompressingRotatingFileHandler, self).__init__(
+            filename, 'a', encoding=encoding)
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.max_archives = max_archives
+        self.compression = compression
+        self.rollover_at = time.time() + interval if interval else None
+        # One thread compresses the archives in rotation order
+        self._compressor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='log-compressor')
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        """ Tell whether writing a record must start a new file
+        Arguments:
+          record -- log record about to be written
+        Returns:
+        True when the file is too large or too old.
+        """
+        if self.rollover_at is not None and record.created >= \
+                self.rollover_at:
+            return True
+        if self.max_bytes > 0:
+            if self.stream is None:
+                self.stream = self._open()
+            # Unlike RotatingFileHandler, the record is not formatted to
+            # measure it, that would redact every record twice
+            return self.stream.tell() >= self.max_bytes
+        return False
+
+    def doRollover(self):
+        """ Move the current file aside and compress it in the background
+        """
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        now = time.time()
+        archive = "{}.{}.{:06d}".format(
+            self.baseFilename, time.strftime("%Y%m%d-%H%M%S",
+                                             time.localtime(now)),
+            int(now % 1 * 1e6))
+        if os.path.exists(self.baseFilename):
+            os.rename(self.baseFilename, archive)
+            self._compressor.submit(self._archive, archive)
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+        self.stream = self._open()
+
+    def _archive(self, path: str):
+        """ Compress a rotated file and apply the retention limit
+        Runs on the compressor thread.
+        Arguments:
+          path -- path of the rotated file
+        """
+        if not os.path.exists(path):
+            # Removed since it was rotated, nothing left to archive
+            return
+        target_path = path + ARCHIVE_SUFFIXES[self.compression]
+        try:
+            if self.compression == 'gzip':
+                with open(path, 'rb') as source, \
+                        gzip.open(path + '.gz', 'wb') as target:
+                    shutil.copyfileobj(source, target)
+                os.remove(path)
+            elif self.compression == 'zstd':
+                with open(path, 'rb') as source, \
+                        open(path + '.zst', 'wb') as target:
+                    zstandard.ZstdCompressor().copy_stream(source, target)
+                os.remove(path)
+        except (OSError,) + ZSTD_ERRORS:
+            # A failed archive must not take logging down with it, the
+            # rotated file is kept and the partial archive removed
+            if target_path != path and os.path.exists(target_path):
+                os.remove(target_path)
+            self.handleError(logging.makeLogRecord(
+                {'msg': "archiving {} failed".format(path)}))
+        try:
+            self._apply_retention()
+        except OSError:
+            self.handleError(logging.makeLogRecord(
+                {'msg': "removing old archives of {} failed".format(
+                    self.baseFilename)}))
+
+    def archives(self, finished: bool = False) -> List[str]:
+        """ List the rotated files of this handler, oldest first
+        Arguments:
+          finished -- leave out the rotated files not compressed yet
+        Returns:
+        The paths of the archives.
+        """
+        directory, base = os.path.split(self.baseFilename)
+        prefix = base + '.'
+        suffix = ARCHIVE_SUFFIXES[self.compression]
+        names = [name for name in os.listdir(directory or '.')
+                 if name.startswith(prefix) and
+                 name[len(prefix):len(prefix) + 8].isdigit() and
+                 (not finished or name.endswith(suffix))]
+        # Timestamps sort in time order, compressed or not
+        names.sort(key=lambda name: name[len(prefix):len(prefix) + 22])
+        return [os.path.join(directory, name) for name in names]
+
+    def _apply_retention(self):
+        """ Remove the oldest archives beyond max_archives
+        Rotated files waiting for their compression don't count, they
+        are removed once compressed if still too old.
+        """
+        if self.max_archives <= 0:
+            return
+        archives = self.archives(finished=True)
+        for path in archives[:-self.max_archives]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """ Close the file and wait for the pending compressions
+        """
+        super(CompressingRotatingFileHandler, self).close()
+        self._compressor.shutdown(wait=True)
+
+
+def get_logger(queued: bool = False, queue_size: int = LOG_QUEUE_SIZE,
+               overflow: str = OVERFLOW_BLOCK,
+               pseudonymizer: Optional[Pseudonymizer] = None,
+               dedup_window: float = 0,
+               sample_rates: Optional[Mapping] = None,
+               log_file: Optional[str] = None) -> logging.Logger:
     """ Get a logger object
+    Calling it again with the same arguments returns the logger as is,
+    with other arguments the previous handler is replaced, never stacked.
+    Arguments:
+      queued -- redact and write records on a background thread
+      queue_size -- maximum number of records waiting when queued
+      overflow -- policy applied when the queue is full, see
+                  OVERFLOW_POLICIES
+      pseudonymizer -- replace PII values with its tokens, not REDACTION
+      dedup_window -- collapse repeated messages within this many seconds,
+                      see DedupSamplingFilter
+      sample_rates -- mapping of levels to the share of their records kept
+      log_file -- write to this rotating, compressed file instead of the
+                  console, PERSONAL_DATA_LOG_FILE by default; see
+                  CompressingRotatingFileHandler for the related settings
     Returns:
     A logging.Logger object.
     """
@@ -91,51 +1340,560 @@ def get_logger() -> logging.Logger:
     logger.setLevel(logging.INFO)  # Set the logger level to INFO
     logger.propagate = False  # Prevent the log messages from being propagated
 
-    # Add a console handler to the logger
-    console_handler = logging.StreamHandler()
+    # Replace the dedup and sampling filter of a previous call, if any
+    for log_filter in list(logger.filters):
+        if isinstance(log_filter, DedupSamplingFilter):
+            logger.removeFilter(log_filter)
+            log_filter.flush()
+    if dedup_window or sample_rates:
+        logger.addFilter(DedupSamplingFilter(dedup_window, sample_rates))
+
+    # Keep the handler installed by a previous call if nothing changed
+    pipeline = ('queued', queue_size, overflow) if queued else ('console',)
+    log_file = log_file or os.getenv('PERSONAL_DATA_LOG_FILE')
+    pipeline += (pseudonymizer, log_file)
+    for handler in list(logger.handlers):
+        if not hasattr(handler, 'redacting_pipeline'):
+            continue
+        if handler.redacting_pipeline == pipeline:
+            return logger
+        logger.removeHandler(handler)
+        handler.close()
 
-    # Set the formatter of the console handler to a RedactingFormatter object
-    formatter = RedactingFormatter(PII_FIELDS)
-    console_handler.setFormatter(formatter)
+    # Add a console handler to the logger, or a file handler if asked to
+    if log_file:
+        output_handler = CompressingRotatingFileHandler(
+            log_file,
+            max_bytes=int(os.getenv('PERSONAL_DATA_LOG_MAX_BYTES',
+                                    LOG_MAX_BYTES)),
+            interval=float(os.getenv('PERSONAL_DATA_LOG_ROTATE_INTERVAL',
+                                     LOG_ROTATE_INTERVAL)),
+            max_archives=int(os.getenv('PERSONAL_DATA_LOG_MAX_ARCHIVES',
+                                       LOG_MAX_ARCHIVES)),
+            compression=os.getenv('PERSONAL_DATA_LOG_COMPRESSION', 'gzip'))
+    else:
+        output_handler = logging.StreamHandler()
 
-    # Add the console handler to the logger
-    logger.addHandler(console_handler)
+    # Set the formatter of the output handler to a RedactingFormatter object
+    formatter = RedactingFormatter(PII_FIELDS, pseudonymizer)
+    output_handler.setFormatter(formatter)
+
+    if queued:
+        # The output handler now runs on the listener thread only
+        handler = BoundedQueueHandler(queue_size, overflow)
+        handler.listener = RedactingQueueListener(
+            handler.queue, output_handler, respect_handler_level=True)
+        handler.listener.start()
+    else:
+        handler = output_handler
+    handler.redacting_pipeline = pipeline
+
+    # Add the handler to the logger
+    logger.addHandler(handler)
     return logger
 
 
+def _db_backend() -> str:
+    """ Read the database backend from the environment
+    Returns:
+    One of DB_BACKENDS, mysql unless PERSONAL_DATA_DB_BACKEND says otherwise.
+    """
+    backend = os.getenv('PERSONAL_DATA_DB_BACKEND', 'mysql').lower()
+    if backend not in DB_BACKENDS:
+        raise ValueError("PERSONAL_DATA_DB_BACKEND must be one of {}".format(
+            ", ".join(DB_BACKENDS)))
+    return backend
+
+
+def _mysql_credentials() -> dict:
+    """ Read the MySQL credentials from the environment
+    Returns:
+    The keyword arguments of mysql.connector.connect().
+    """
+    # Retrieve database credentials from environment variables
+    return {
+        'user': os.getenv('PERSONAL_DATA_DB_USERNAME', 'root'),
+        'password': os.getenv('PERSONAL_DATA_DB_PASSWORD', ''),
+        'host': os.getenv('PERSONAL_DATA_DB_HOST', 'localhost'),
+        'database': os.getenv('PERSONAL_DATA_DB_NAME'),
+    }
+
+
+def _sqlite_connect() -> sqlite3.Connection:
+    """ Open a connection to the SQLite stand-in database
+    PERSONAL_DATA_DB_NAME is the path of the database file.
+    Returns:
+    A sqlite3 connection usable from any thread.
+    """
+    db_name = os.getenv('PERSONAL_DATA_DB_NAME') or ':memory:'
+    return sqlite3.connect(db_name, check_same_thread=False)
+
+
 def get_db() -> connection.MySQLConnection:
     """ We use this function to get a database connection.
     By using environment variables, we can connect to the database.
+    With PERSONAL_DATA_DB_BACKEND=sqlite, PERSONAL_DATA_DB_NAME is opened
+    as a SQLite database instead, so no MySQL server is needed.
     Returns:
     A MySQL connection object to the database.
     """
-    # Retrieve database credentials from environment variables
-    db_username = os.getenv('PERSONAL_DATA_DB_USERNAME', 'root')
-    db_password = os.getenv('PERSONAL_DATA_DB_PASSWORD', '')
-    db_host = os.getenv('PERSONAL_DATA_DB_HOST', 'localhost')
-    db_name = os.getenv('PERSONAL_DATA_DB_NAME')
+    if _db_backend() == 'sqlite':
+        return _sqlite_connect()
 
     # Establish and return a connection to the database
-    return mysql.connector.connect(
-        user=db_username,
-        password=db_password,
-        host=db_host,
-        database=db_name
-    )
+    return mysql.connector.connect(**_mysql_credentials())
+
+
+class PooledSQLiteConnection:
+    """ Pooled SQLite Connection class
+    Proxy to a sqlite3 connection whose close() hands the connection
+    back to its pool, like a pooled MySQL connection does.
+    """
+
+    def __init__(self, pool: 'SQLiteConnectionPool', cnx: sqlite3.Connection):
+        """ Initialize the PooledSQLiteConnection object
+        Arguments:
+          pool -- pool the connection is returned to
+          cnx -- underlying sqlite3 connection
+        """
+        self._pool = pool
+        self._cnx = cnx
+
+    def __getattr__(self, name: str):
+        """ Delegate everything else to the sqlite3 connection """
+        if self._cnx is None:
+            raise PoolError("Connection was returned to the pool")
+        return getattr(self._cnx, name)
+
+    def close(self):
+        """ Roll back pending work and return the connection to the pool
+        """
+        cnx, self._cnx = self._cnx, None
+        if cnx is not None:
+            cnx.rollback()
+            self._pool.add_connection(cnx)
+
+
+class SQLiteConnectionPool:
+    """ SQLite Connection Pool class
+    Stand-in for mysql.connector.pooling.MySQLConnectionPool, it raises
+    the same PoolError when every connection is in use.
+    """
+
+    def __init__(self, pool_size: int = DB_POOL_SIZE):
+        """ Initialize the SQLiteConnectionPool object
+        Arguments:
+          pool_size -- number of connections opened
+        """
+        self.pool_size = pool_size
+        self._idle = queue.Queue(pool_size)
+        for _ in range(pool_size):
+            self._idle.put(_sqlite_connect())
+
+    def add_connection(self, cnx: sqlite3.Connection):
+        """ Return a connection to the pool
+        Arguments:
+          cnx -- sqlite3 connection taken from this pool
+        """
+        self._idle.put_nowait(cnx)
+
+    def get_connection(self) -> PooledSQLiteConnection:
+        """ Take a connection from the pool
+        Returns:
+        A PooledSQLiteConnection, close() returns it to the pool.
+        """
+        try:
+            cnx = self._idle.get_nowait()
+        except queue.Empty:
+            raise PoolError("Failed getting connection; pool exhausted")
+        return PooledSQLiteConnection(self, cnx)
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    """ Get the process wide connection pool, created on first use
+    Its size comes from PERSONAL_DATA_DB_POOL_SIZE (DB_POOL_SIZE by default)
+    and its backend from PERSONAL_DATA_DB_BACKEND, like get_db().
+    Returns:
+    A MySQLConnectionPool, or a SQLiteConnectionPool for the sqlite backend.
+    """
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            pool_size = int(os.getenv('PERSONAL_DATA_DB_POOL_SIZE',
+                                      DB_POOL_SIZE))
+            if _db_backend() == 'sqlite':
+                _db_pool = SQLiteConnectionPool(pool_size)
+            else:
+                _db_pool = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name='personal_data', pool_size=pool_size,
+                    **_mysql_credentials())
+        return _db_pool
+
+
+@contextmanager
+def db_connection() -> Iterator[connection.MySQLConnection]:
+    """ Borrow a connection from the pool for the duration of a block
+    Example usage:
+        with db_connection() as db:
+            cursor = db.cursor()
+    Returns:
+    A context manager giving a pooled connection, returned on exit.
+    """
+    db = get_db_pool().get_connection()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def _export_writer(output: TextIO, export_format: str,
+                   columns: Sequence[str],
+                   fields: Sequence[str]) -> Callable[[list], None]:
+    """ Build the function writing one batch of rows in an export format
+    Log lines are redacted with filter_datum_batch(), NDJSON and CSV rows
+    have the values of the columns matched by the fields replaced.
+    Arguments:
+      output -- text stream receiving the exported rows
+      export_format -- one of EXPORT_FORMATS
+      columns -- column names of the rows
+      fields -- list of strings representing fields to obfuscate
+    Returns:
+    A function taking a list of rows and writing them redacted.
+    """
+    redaction = RedactingFormatter.REDACTION
+    separator = RedactingFormatter.SEPARATOR
+
+    if export_format == 'log':
+        def write_batch(rows: list):
+            """ Write rows as redacted `key=value;` log lines """
+            messages = ["".join("{}={}; ".format(k, v)
+                                for k, v in zip(columns, row)).strip()
+                        for row in rows]
+            lines = filter_datum_batch(fields, redaction, messages, separator)
+            output.write("\n".join(lines) + "\n")
+        return write_batch
+
+    # Columns are matched like keys of a log line, once for the export
+    matches = _compile_key_matcher(tuple(fields))
+    redacted = [matches(column) for column in columns]
+
+    def redact_row(row: Sequence) -> list:
+        """ Replace the values of the redacted columns """
+        return [redaction if hidden else value
+                for hidden, value in zip(redacted, row)]
 
+    if export_format == 'ndjson':
+        def write_batch(rows: list):
+            """ Write rows as redacted JSON documents, one per line """
+            output.write("".join(
+                json.dumps(dict(zip(columns, redact_row(row))),
+                           default=str) + "\n" for row in rows))
+        return write_batch
 
-def main():
+    if export_format == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(columns)
+
+        def write_batch(rows: list):
+            """ Write rows as redacted CSV records """
+            writer.writerows(redact_row(row) for row in rows)
+        return write_batch
+
+    raise ValueError("export_format must be one of {}".format(
+        ", ".join(EXPORT_FORMATS)))
+
+
+def _quote_identifier(name: str) -> str:
+    """ Quote a table or column name, MySQL and SQLite both take backticks
+    Arguments:
+      name -- identifier to quote
+    Returns:
+    The quoted identifier.
+    """
+    return "`{}`".format(name.replace("`", "``"))
+
+
+def table_columns(db, table: str) -> List[str]:
+    """ Read the column names of a table from its metadata
+    Arguments:
+      db -- database connection
+      table -- name of the table
+    Returns:
+    The list of column names, in table order.
+    """
+    cursor = db.cursor()
+    cursor.execute("SELECT * FROM {} LIMIT 0;".format(
+        _quote_identifier(table)))
+    columns = [description[0] for description in cursor.description]
+    cursor.fetchall()
+    cursor.close()
+    return columns
+
+
+def masked_select(db, table: str, fields: Sequence[str] = PII_FIELDS,
+                  pii_columns: str = 'mask') -> str:
+    """ Build a SELECT that keeps PII columns inside the database
+    Columns are matched like the keys of a log line by filter_datum(), a
+    matched column comes back as the redaction constant, or not at all.
+    Arguments:
+      db -- database connection
+      table -- name of the table
+      fields -- list of strings representing fields to obfuscate
+      pii_columns -- one of PII_COLUMN_MODES
+    Returns:
+    The SELECT statement.
+    """
+    if pii_columns not in PII_COLUMN_MODES:
+        raise ValueError("pii_columns must be one of {}".format(
+            ", ".join(PII_COLUMN_MODES)))
+    if pii_columns == 'fetch':
+        return "SELECT * FROM {};".format(_quote_identifier(table))
+
+    redaction = RedactingFormatter.REDACTION
+    if "\\" in redaction:
+        # MySQL and SQLite disagree on backslashes in string literals
+        raise ValueError("the redaction can't contain a backslash")
+    mask = "'{}'".format(redaction.replace("'", "''"))
+    matches = _compile_key_matcher(tuple(fields))
+
+    select_list = []
+    for column in table_columns(db, table):
+        if not matches(column):
+            select_list.append(_quote_identifier(column))
+        elif pii_columns == 'mask':
+            select_list.append("{} AS {}".format(
+                mask, _quote_identifier(column)))
+    if not select_list:
+        raise ValueError("every column of {} is PII".format(table))
+    return "SELECT {} FROM {};".format(", ".join(select_list),
+                                       _quote_identifier(table))
+
+
+def export_table(db, table: str, output: TextIO,
+                 export_format: str = 'log',
+                 batch_size: int = EXPORT_BATCH_SIZE,
+                 fields: Sequence[str] = PII_FIELDS,
+                 pii_columns: str = 'mask') -> int:
+    """ Stream a table, redacted, to a text stream
+    Rows are read with fetchmany() so only one batch is held in memory,
+    and every batch is redacted and written in one call.
+    PII columns are masked by the SELECT itself unless pii_columns says
+    otherwise, see masked_select().
+    The throughput is reported on stderr.
+    Arguments:
+      db -- database connection
+      table -- name of the table
+      output -- text stream receiving the exported rows
+      export_format -- one of EXPORT_FORMATS
+      batch_size -- number of rows fetched and written at once
+      fields -- list of strings representing fields to obfuscate
+      pii_columns -- one of PII_COLUMN_MODES
+    Returns:
+    The number of exported rows.
+    """
+    start = time.perf_counter()
+    query = masked_select(db, table, fields, pii_columns)
+    cursor = db.cursor()
+    cursor.execute(query)
+    columns = [description[0] for description in cursor.description]
+    write_batch = _export_writer(output, export_format, columns, fields)
+
+    exported = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        write_batch(rows)
+        exported += len(rows)
+    cursor.close()
+    output.flush()
+
+    elapsed = time.perf_counter() - start
+    print("{}: exported {} rows in {:.2f}s ({:.0f} rows/sec)".format(
+        table, exported, elapsed, exported / elapsed if elapsed else 0),
+        file=sys.stderr)
+    return exported
+
+
+def export_users(db, output: TextIO, export_format: str = 'log',
+                 batch_size: int = EXPORT_BATCH_SIZE,
+                 fields: Sequence[str] = PII_FIELDS,
+                 pii_columns: str = 'mask') -> int:
+    """ Stream the users table, redacted, to a text stream
+    Arguments:
+      db -- database connection
+      output -- text stream receiving the exported rows
+      export_format -- one of EXPORT_FORMATS
+      batch_size -- number of rows fetched and written at once
+      fields -- list of strings representing fields to obfuscate
+      pii_columns -- one of PII_COLUMN_MODES
+    Returns:
+    The number of exported rows.
+    """
+    return export_table(db, 'users', output, export_format, batch_size,
+                        fields, pii_columns)
+
+
+def parse_table_spec(spec: str) -> Tuple[str, Tuple[str, ...]]:
+    """ Parse a `table` or `table=field,field` export argument
+    Arguments:
+      spec -- table name, optionally followed by its own field list
+    Returns:
+    A (table, fields) tuple, the fields are PII_FIELDS when not given.
+    """
+    table, equal, fields = spec.partition('=')
+    if not table:
+        raise ValueError("missing table name in {!r}".format(spec))
+    if not equal:
+        return table, PII_FIELDS
+    return table, tuple(field for field in fields.split(',') if field)
+
+
+def _export_to_file(table: str, fields: Sequence[str], path: str,
+                    export_format: str, batch_size: int,
+                    pii_columns: str) -> Tuple[int, float]:
+    """ Export one table to its own file over a pooled connection
+    Runs on the threads of export_tables().
+    Arguments:
+      table -- name of the table
+      fields -- list of strings representing fields to obfuscate
+      path -- path of the file to write
+      export_format -- one of EXPORT_FORMATS
+      batch_size -- number of rows fetched and written at once
+      pii_columns -- one of PII_COLUMN_MODES
+    Returns:
+    A (rows, seconds) tuple.
+    """
+    start = time.perf_counter()
+    with db_connection() as db, open(path, 'w', newline='') as output:
+        rows = export_table(db, table, output, export_format, batch_size,
+                            fields, pii_columns)
+    return rows, time.perf_counter() - start
+
+
+def export_tables(tables: Mapping, output_dir: str = '.',
+                  export_format: str = 'log',
+                  batch_size: int = EXPORT_BATCH_SIZE,
+                  pii_columns: str = 'mask', workers: int = None) -> \
+        Dict[str, dict]:
+    """ Export several tables concurrently, one file per table
+    Each table is exported on its own thread with its own connection from
+    get_db_pool() and its own field list, to `<table>.<format>` in
+    output_dir. The exports mostly wait on the database, threads let them
+    overlap. Per-table and total timings are reported on stderr.
+    Arguments:
+      tables -- mapping of table names to their fields to obfuscate
+      output_dir -- directory receiving the files
+      export_format -- one of EXPORT_FORMATS
+      batch_size -- number of rows fetched and written at once
+      pii_columns -- one of PII_COLUMN_MODES
+      workers -- number of tables exported at once, bounded by the size
+                 of the connection pool
+    Returns:
+    A dictionary mapping each table to its path, rows and seconds.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError("export_format must be one of {}".format(
+            ", ".join(EXPORT_FORMATS)))
+    # A worker more than there are connections would hit PoolError
+    pool_size = get_db_pool().pool_size
+    workers = max(min(workers or pool_size, pool_size, len(tables)), 1)
+    os.makedirs(output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for table, fields in tables.items():
+            path = os.path.join(output_dir, "{}.{}".format(
+                os.path.basename(table), export_format))
+            futures[table] = (path, executor.submit(
+                _export_to_file, table, fields, path, export_format,
+                batch_size, pii_columns))
+        for table, (path, future) in futures.items():
+            rows, seconds = future.result()
+            results[table] = {'path': path, 'rows': rows,
+                              'seconds': seconds}
+
+    elapsed = time.perf_counter() - start
+    for table, result in results.items():
+        print("{:<20} {:>10} rows {:>8.2f}s  {}".format(
+            table, result['rows'], result['seconds'], result['path']),
+            file=sys.stderr)
+    print("exported {} tables in {:.2f}s with {} workers".format(
+        len(results), elapsed, workers), file=sys.stderr)
+    return results
+
+
+def main(argv: List[str] = None):
     """
     Main function to retrieve & display filtered user data from the database.
+    With --export, the users table is streamed in batches to a file or
+    stdout instead of being logged row by row.
+    With --tables, several tables are exported concurrently, one file per
+    table in --output-dir:
+        ./filtered_logger.py --tables users orders=email,card_number
+    Arguments:
+      argv -- command line arguments, sys.argv[1:] by default
     """
+    parser = argparse.ArgumentParser(
+        description="Display or export the users table, redacted")
+    parser.add_argument('--export', action='store_true',
+                        help="stream the table in batches instead of logging")
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='log',
+                        help="export format (default: log)")
+    parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE,
+                        help="rows fetched per batch (default: %(default)s)")
+    parser.add_argument('--output', help="export file (default: stdout)")
+    parser.add_argument('--pii-columns', choices=PII_COLUMN_MODES,
+                        default='mask',
+                        help="mask PII columns in SQL, omit them or fetch "
+                        "them and redact in Python (default: mask)")
+    parser.add_argument('--tables', nargs='+', metavar='TABLE[=FIELDS]',
+                        help="export these tables concurrently, each with "
+                        "its comma separated fields (default: PII_FIELDS)")
+    parser.add_argument('--output-dir', default='.',
+                        help="directory of the --tables files "
+                        "(default: %(default)s)")
+    parser.add_argument('--workers', type=int,
+                        help="tables exported at once with --tables "
+                        "(default: the connection pool size)")
+    args = parser.parse_args(argv)
+
+    if args.tables:
+        try:
+            tables = dict(map(parse_table_spec, args.tables))
+        except ValueError as error:
+            parser.error(str(error))
+        export_tables(tables, args.output_dir, args.format, args.batch_size,
+                      args.pii_columns, args.workers)
+        return
+
     # get a database connection
     db = get_db()
+    if args.export:
+        output = open(args.output, 'w', newline='') \
+            if args.output else sys.stdout
+        try:
+            export_users(db, output, args.format, args.batch_size,
+                         pii_columns=args.pii_columns)
+        finally:
+            if args.output:
+                output.close()
+            db.close()
+        return
+
     logger = get_logger()
+    query = masked_select(db, 'users', PII_FIELDS, args.pii_columns)
     cursor = db.cursor()
 
     # Retrieve all rows from the users table
-    cursor.execute("SELECT * FROM users;")
-    fields = cursor.column_names
+    cursor.execute(query)
+    fields = [description[0] for description in cursor.description]
 
     # Iterate over each row and log the filtered data
     for row in cursor:
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+
+""" Redact an existing log file in parallel
+This module scrubs old, unredacted log files with the same rules as
+filter_datum(). The input file is memory-mapped and split into chunks on
+line boundaries, the chunks are redacted by a pool of processes and
+written back in order to the output file.
+Example usage:
+    ./redact_log_file.py app.log app.redacted.log --workers 8
+Running with --workers 1 redacts on the current process only, which gives
+the single-threaded throughput to compare against.
+With --json, every line is a JSON document redacted with filter_json().
+With --follow, the source is followed like `tail -f` and the lines
+appended to it are redacted as they arrive, `-` reads stdin or writes
+stdout:
+    ./redact_log_file.py app.log - --follow
+"""
+
+import argparse
+import mmap
+import os
+import select
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from filtered_logger import (PII_FIELDS, RedactingFormatter,
+                             filter_lines_bytes, filter_ndjson)
+
+# Default size of the chunks handed to the workers, in bytes
+CHUNK_SIZE = 8 * 1024 * 1024
+# Follow mode: size of each read, in bytes, seconds to wait for new data
+# at the end of a file and seconds between two status reports
+FOLLOW_READ_SIZE = 1024 * 1024
+FOLLOW_POLL_INTERVAL = 0.1
+STATUS_INTERVAL = 10.0
+
+
+def split_chunks(path: str, chunk_size: int = CHUNK_SIZE) -> \
+        List[Tuple[int, int]]:
+    """ Split a file into chunks ending on a line boundary
+    Arguments:
+      path -- path of the file to split
+      chunk_size -- approximate size of each chunk, in bytes
+    Returns:
+    A list of (start, end) byte offsets covering the whole file.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    chunks = []
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        start = 0
+        while start < size:
+            # Extend the chunk up to the end of the line it stops in
+            newline = mapped.find(b'\n', min(start + chunk_size, size) - 1)
+            end = size if newline == -1 else newline + 1
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def redact_chunk(path: str, start: int, end: int, fields: Sequence[str],
+                 redaction: str, separator: str,
+                 json_lines: bool = False) -> bytearray:
+    """ Redact one chunk of a file, line by line
+    Runs in the worker processes, the chunk is read from the mapping so
+    only the offsets travel to the worker.
+    Arguments:
+      path -- path of the file to redact
+      start -- offset of the first byte of the chunk
+      end -- offset after the last byte of the chunk
+      fields -- list of strings representing fields to obfuscate
+      redaction -- string to replace field values with
+      separator -- character separating fields in the log line
+      json_lines -- the lines are JSON documents (NDJSON)
+    Returns:
+    The redacted chunk, as a bytes-like object.
+    """
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, \
+            memoryview(mapped)[start:end] as data:
+        # Read from the mapping, no read() call, the redactor still copies
+        # the chunk once to split it into lines
+        return redact_lines(data, fields, redaction, separator, json_lines)
+
+
+def redact_chunks(path: str, chunks: List[Tuple[int, int]],
+                  fields: Sequence[str], redaction: str, separator: str,
+                  workers: int, json_lines: bool = False) -> \
+        Iterator[bytes]:
+    """ Redact chunks and yield them in file order
+    At most two chunks per worker are in flight, so memory stays bounded
+    whatever the size of the file.
+    Arguments:
+      path -- path of the file to redact
+      chunks -- (start, end) offsets returned by split_chunks()
+      fields -- list of strings representing fields to obfuscate
+      redaction -- string to replace field values with
+      separator -- character separating fields in the log line
+      workers -- number of worker processes, 1 redacts in process
+      json_lines -- the lines are JSON documents (NDJSON)
+    Returns:
+    An iterator of redacted chunks.
+    """
+    if workers <= 1:
+        for start, end in chunks:
+            yield redact_chunk(path, start, end, fields, redaction,
+                               separator, json_lines)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for start, end in chunks:
+            pending.append(executor.submit(
+                redact_chunk, path, start, end, fields, redaction,
+                separator, json_lines))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def redact_file(source: str, destination: str,
+                fields: Sequence[str] = PII_FIELDS,
+                redaction: str = RedactingFormatter.REDACTION,
+                separator: str = RedactingFormatter.SEPARATOR,
+                workers: int = None, chunk_size: int = CHUNK_SIZE,
+                progress: bool = True, json_lines: bool = False) -> float:
+    """ Redact a log file into another file
+    Arguments:
+      source -- path of the log file to redact
+      destination -- path of the redacted file to write
+      fields -- list of strings representing fields to obfuscate
+      redaction -- string to replace field values with
+      separator -- character separating fields in the log line
+      workers -- number of worker processes, os.cpu_count() by default
+      chunk_size -- approximate size of each chunk, in bytes
+      progress -- report the progress and throughput on stderr
+      json_lines -- the lines are JSON documents (NDJSON)
+    Returns:
+    The throughput, in bytes of input per second.
+    """
+    workers = workers or os.cpu_count() or 1
+    start_time = time.perf_counter()
+    chunks = split_chunks(source, chunk_size)
+    total = chunks[-1][1] if chunks else 0
+
+    done = 0
+    with open(destination, 'wb') as output:
+        redacted = redact_chunks(source, chunks, fields, redaction,
+                                 separator, workers, json_lines)
+        for (start, end), data in zip(chunks, redacted):
+            output.write(data)
+            done += end - start
+            if progress:
+                print("\r{:6.1%} of {} bytes".format(done / total, total),
+                      end='', file=sys.stderr)
+
+    elapsed = time.perf_counter() - start_time
+    throughput = total / elapsed if elapsed else 0
+    if progress:
+        print("\nredacted {} bytes in {:.2f}s ({:.1f} MB/s, {} workers)"
+              .format(total, elapsed, throughput / 1e6, workers),
+              file=sys.stderr)
+    return throughput
+
+
+def redact_lines(data: bytes, fields: Sequence[str], redaction: str,
+                 separator: str, json_lines: bool = False) -> bytearray:
+    """ Redact a block of complete lines
+    Arguments:
+      data -- lines to redact, as bytes or a memoryview
+      fields -- list of strings representing fields to obfuscate
+      redaction -- string to replace field values with
+      separator -- character separating fields in the log line
+      json_lines -- the lines are JSON documents (NDJSON)
+    Returns:
+    The redacted lines, as a bytes-like object.
+    """
+    if not json_lines:
+        # Redacted as bytes, without decoding and encoding the block
+        return filter_lines_bytes(fields, redaction, data, separator)
+    # surrogateescape lets bytes that are not UTF-8 round-trip as is
+    text = str(data, 'utf-8', 'surrogateescape')
+    lines = filter_ndjson(fields, text.split('\n'), redaction)
+    return bytearray('\n'.join(lines), 'utf-8', 'surrogateescape')
+
+
+def follow_file(source: str, destination: str,
+                fields: Sequence[str] = PII_FIELDS,
+                redaction: str = RedactingFormatter.REDACTION,
+                separator: str = RedactingFormatter.SEPARATOR,
+                json_lines: bool = False, from_start: bool = False,
+                read_size: int = FOLLOW_READ_SIZE,
+                poll_interval: float = FOLLOW_POLL_INTERVAL,
+                status_interval: float = STATUS_INTERVAL,
+                stop: Optional[threading.Event] = None) -> dict:
+    """ Redact the lines appended to a file or stdin as they arrive
+    Every read takes up to read_size bytes and all the complete lines it
+    holds are redacted and written at once, so a busy source costs one
+    write per read instead of one per line. A line is only written once
+    its newline has arrived, half a line is never redacted on its own.
+    Output is flushed after every write, the latency of a line is then
+    bounded by poll_interval. A file that is truncated or replaced, as by
+    log rotation, is reopened from its start.
+    Arguments:
+      source -- path of the file to follow, `-` for stdin
+      destination -- path of the file to append to, `-` for stdout
+      fields -- list of strings representing fields to obfuscate
+      redaction -- string to replace field values with
+      separator -- character separating fields in the log line
+      json_lines -- the lines are JSON documents (NDJSON)
+      from_start -- redact what the file already holds, not only what is
+                    appended to it
+      read_size -- maximum number of bytes read at once
+      poll_interval -- seconds to wait for new data at the end of the file
+      status_interval -- seconds between two throughput and lag reports on
+                         stderr, 0 to disable them
+      stop -- event ending the loop when set, stdin also ends at EOF
+    Returns:
+    A dictionary counting the bytes and lines redacted.
+    """
+    stats = {'bytes': 0, 'lines': 0}
+    stdin = source == '-'
+    reader = sys.stdin.buffer.raw if stdin else open(source, 'rb',
+                                                     buffering=0)
+    writer = sys.stdout.buffer if destination == '-' \
+        else open(destination, 'ab')
+    if not stdin and not from_start:
+        reader.seek(0, os.SEEK_END)
+
+    pending = b''
+    last_bytes = 0
+    last_status = time.monotonic()
+    try:
+        while stop is None or not stop.is_set():
+            if stdin:
+                # Wake up on status intervals even if stdin stays silent
+                ready, _, _ = select.select(
+                    [reader], [], [], status_interval or None)
+                data = reader.read(read_size) if ready else None
+                if data == b'':
+                    break
+            else:
+                data = reader.read(read_size)
+                if not data:
+                    if _rotated(source, reader):
+                        reader.close()
+                        reader = open(source, 'rb', buffering=0)
+                    else:
+                        time.sleep(poll_interval)
+
+            if data:
+                stats['bytes'] += len(data)
+                pending += data
+                newline = pending.rfind(b'\n')
+                if newline != -1:
+                    complete = pending[:newline + 1]
+                    pending = pending[newline + 1:]
+                    stats['lines'] += complete.count(b'\n')
+                    writer.write(redact_lines(complete, fields, redaction,
+                                              separator, json_lines))
+                    writer.flush()
+
+            now = time.monotonic()
+            if status_interval and now - last_status >= status_interval:
+                lag = '-' if stdin else _lag(reader)
+                print("{} lines, {:.1f} MB/s, lag {} bytes, {} buffered"
+                      .format(stats['lines'],
+                              (stats['bytes'] - last_bytes) /
+                              (now - last_status) / 1e6,
+                              lag, len(pending)), file=sys.stderr)
+                last_status, last_bytes = now, stats['bytes']
+        if pending and stdin:
+            # The input is over, its last line won't get a newline
+            stats['lines'] += 1
+            writer.write(redact_lines(pending, fields, redaction,
+                                      separator, json_lines))
+            writer.flush()
+    finally:
+        if not stdin:
+            reader.close()
+        if destination != '-':
+            writer.close()
+    return stats
+
+
+def _rotated(path: str, reader) -> bool:
+    """ Tell whether a followed file was truncated or replaced
+    Arguments:
+      path -- path of the followed file
+      reader -- file object open on it
+    Returns:
+    True when the file must be reopened from its start.
+    """
+    try:
+        current = os.stat(path)
+    except OSError:
+        # Removed and not recreated yet, keep the old one open
+        return False
+    opened = os.fstat(reader.fileno())
+    return current.st_ino != opened.st_ino or \
+        current.st_dev != opened.st_dev or current.st_size < reader.tell()
+
+
+def _lag(reader) -> int:
+    """ Number of bytes of a followed file not read yet
+    Arguments:
+      reader -- file object open on the followed file
+    Returns:
+    The distance to the end of the file, in bytes.
+    """
+    return max(os.fstat(reader.fileno()).st_size - reader.tell(), 0)
+
+
+def main(argv: List[str] = None):
+    """
+    Main function to redact a log file from the command line.
+    Arguments:
+      argv -- command line arguments, sys.argv[1:] by default
+    """
+    parser = argparse.ArgumentParser(
+        description="Redact PII fields of an existing log file")
+    parser.add_argument('source', help="log file to redact")
+    parser.add_argument('destination', help="redacted file to write")
+    parser.add_argument('--fields', default=",".join(PII_FIELDS),
+                        help="comma separated fields (default: %(default)s)")
+    parser.add_argument('--redaction', default=RedactingFormatter.REDACTION,
+                        help="replacement value (default: %(default)s)")
+    parser.add_argument('--separator', default=RedactingFormatter.SEPARATOR,
+                        help="field separator (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="worker processes (default: %(default)s)")
+    parser.add_argument('--chunk-size', type=int,
+                        default=CHUNK_SIZE // (1024 * 1024),
+                        help="chunk size in MiB (default: %(default)s)")
+    parser.add_argument('--json', action='store_true',
+                        help="lines are JSON documents, fields are keys or "
+                        "dotted key paths")
+    parser.add_argument('--follow', action='store_true',
+                        help="redact lines as they are appended to the "
+                        "source, like tail -f")
+    parser.add_argument('--from-start', action='store_true',
+                        help="with --follow, redact the existing content "
+                        "first")
+    parser.add_argument('--status-interval', type=float,
+                        default=STATUS_INTERVAL,
+                        help="with --follow, seconds between status "
+                        "reports (default: %(default)s)")
+    parser.add_argument('--quiet', action='store_true',
+                        help="do not report progress")
+    args = parser.parse_args(argv)
+    fields = [field for field in args.fields.split(',') if field]
+
+    if args.follow:
+        try:
+            follow_file(args.source, args.destination, fields=fields,
+                        redaction=args.redaction, separator=args.separator,
+                        json_lines=args.json, from_start=args.from_start,
+                        status_interval=0 if args.quiet
+                        else args.status_interval)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    redact_file(args.source, args.destination,
+                fields=fields,
+                redaction=args.redaction, separator=args.separator,
+                workers=args.workers,
+                chunk_size=args.chunk_size * 1024 * 1024,
+                progress=not args.quiet, json_lines=args.json)
+
+
+if __name__ == "__main__":
+    main()
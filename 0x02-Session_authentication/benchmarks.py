@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+""" Benchmark of the model store loaders
+This module measures, for the eager loader and the lazy one (LAZY_LOAD=1):
+  - the time load_from_file() takes on a .db_User.json of many users
+  - the time of a first User.get() and User.search() by email after it
+  - the peak RSS of the process
+Each loader runs in its own process so their peak RSS don't mix.
+It also measures the bytes per User object of the __slots__ models,
+against the same attributes held in a per-instance __dict__ as the
+models did before, and the time of a full save_to_file() and of a
+listing of every user, with the serializations cached or not.
+Example usage:
+    ./benchmarks.py --users 200000 --output bench.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Callable, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_store(directory: str, user_count: int):
+    """ Write a .db_User.json like save_to_file() would
+    Arguments:
+      directory -- directory receiving the file
+      user_count -- number of users in the file
+    """
+    now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+    users = {}
+    for i in range(user_count):
+        user_id = "{:08d}-0000-4000-8000-000000000000".format(i)
+        users[user_id] = {
+            'id': user_id, 'created_at': now, 'updated_at': now,
+            'email': "user{}@example.com".format(i),
+            '_password': "{:064x}".format(i),
+            'first_name': "First{}".format(i),
+            'last_name': "Last{}".format(i),
+        }
+    with open(os.path.join(directory, '.db_User.json'), 'w') as f:
+        json.dump(users, f)
+
+
+def run_child(user_count: int) -> dict:
+    """ Load the store of the current directory and time the first requests
+    Runs in the child process, the loader is picked by LAZY_LOAD.
+    Arguments:
+      user_count -- number of users in the store
+    Returns:
+    A dictionary of timings, in seconds, and of the peak RSS, in KiB.
+    """
+    sys.path.insert(0, HERE)
+    from models.user import User
+
+    start = time.perf_counter()
+    User.load_from_file()
+    loaded = time.perf_counter()
+    user = User.get("{:08d}-0000-4000-8000-000000000000".format(
+        user_count // 2))
+    got = time.perf_counter()
+    found = User.search({'email': "user{}@example.com".format(
+        user_count // 3)})
+    searched = time.perf_counter()
+    assert user is not None and len(found) == 1
+    return {
+        'load_sec': loaded - start,
+        'first_get_sec': got - loaded,
+        'first_search_sec': searched - got,
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+class DictUser:
+    """ User laid out like the models were before __slots__
+    """
+
+    def __init__(self, **kwargs: dict):
+        """ Set the attributes of a User, in the same order
+        """
+        self.id = kwargs['id']
+        self.created_at = datetime.strptime(kwargs['created_at'],
+                                            "%Y-%m-%dT%H:%M:%S")
+        self.updated_at = datetime.strptime(kwargs['updated_at'],
+                                            "%Y-%m-%dT%H:%M:%S")
+        self.email = kwargs.get('email')
+        self._password = kwargs.get('_password')
+        self.first_name = kwargs.get('first_name')
+        self.last_name = kwargs.get('last_name')
+
+
+def _traced_bytes(build: Callable[[], list]) -> int:
+    """ Bytes allocated by build() and still held by what it returns
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objs = build()
+        held = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del objs
+    return held
+
+
+def bench_memory(user_count: int) -> List[dict]:
+    """ Compare the bytes per User object with and without __slots__
+    The strings are built before the measure, so the objects and their
+    timestamps are counted, not the values shared with the rows.
+    Arguments:
+      user_count -- number of objects to build
+    Returns:
+    A list of result dictionaries, one per layout.
+    """
+    sys.path.insert(0, HERE)
+    from models.user import User
+
+    now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+    rows = [{'id': "{:08d}-0000-4000-8000-000000000000".format(i),
+             'created_at': now, 'updated_at': now,
+             'email': "user{}@example.com".format(i),
+             '_password': "{:064x}".format(i),
+             'first_name': "First{}".format(i),
+             'last_name': "Last{}".format(i)} for i in range(user_count)]
+    results = []
+    for layout, cls in (('__dict__', DictUser), ('__slots__', User)):
+        held = _traced_bytes(lambda: [cls(**row) for row in rows])
+        sample = cls(**rows[0])
+        shallow = sys.getsizeof(sample)
+        if hasattr(sample, '__dict__'):
+            shallow += sys.getsizeof(sample.__dict__)
+        result = {'layout': layout, 'users': user_count,
+                  'bytes_per_object': round(held / user_count, 1),
+                  'shallow_bytes': shallow}
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+    return results
+
+
+def bench_serialization(user_count: int) -> List[dict]:
+    """ Time full saves and listings, first cold then with one change
+    Runs in a temporary directory, with the users of make_store().
+    Arguments:
+      user_count -- number of users in the store
+    Returns:
+    A list of result dictionaries, one per operation and cache state.
+    """
+    sys.path.insert(0, HERE)
+    from models.user import User
+
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        make_store(directory, user_count)
+        os.chdir(directory)
+        try:
+            User.load_from_file()
+            users = User.all()
+            for operation, run in (
+                    ('save_to_file', User.save_to_file),
+                    ('listing', lambda: [u.to_json() for u in users])):
+                for cache in ('cold', 'one_changed'):
+                    if cache == 'cold':
+                        for user in users:
+                            user.first_name = user.first_name
+                    else:
+                        users[0].first_name = "Changed"
+                    start = time.perf_counter()
+                    run()
+                    result = {'operation': operation, 'cache': cache,
+                              'users': user_count,
+                              'sec': time.perf_counter() - start}
+                    print(json.dumps(result), file=sys.stderr)
+                    results.append(result)
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def bench_load(user_count: int) -> List[dict]:
+    """ Compare the eager and lazy loaders on the same store
+    Arguments:
+      user_count -- number of users in the store
+    Returns:
+    A list of result dictionaries, one per loader.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        make_store(directory, user_count)
+        for loader in ('eager', 'lazy'):
+            env = dict(os.environ, STORAGE_MODE='file',
+                       LAZY_LOAD='1' if loader == 'lazy' else '0')
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--child',
+                 '--users', str(user_count)],
+                cwd=directory, env=env, check=True,
+                stdout=subprocess.PIPE).stdout
+            result = dict(json.loads(output), loader=loader,
+                          users=user_count)
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+    return results
+
+
+def main(argv: List[str] = None):
+    """
+    Main function to run the benchmark from the command line.
+    Arguments:
+      argv -- command line arguments, sys.argv[1:] by default
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the model store loaders")
+    parser.add_argument('--users', type=int, default=100000,
+                        help="users in the store (default: %(default)s)")
+    parser.add_argument('--output', help="JSON results file "
+                        "(default: stdout)")
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_child(args.users)))
+        return
+
+    results = bench_load(args.users) + bench_memory(args.users) + \
+        bench_serialization(args.users)
+    report = json.dumps({'timestamp': datetime.utcnow().isoformat(),
+                         'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
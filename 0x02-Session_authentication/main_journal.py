@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+""" Main journal
+Checks of the storage modes, run in a temporary directory
+"""
+import os
+import tempfile
+import threading
+from models.user import User
+
+os.environ['STORAGE_MODE'] = 'journal'
+os.environ['JOURNAL_COMPACT_SIZE'] = '2000'
+os.chdir(tempfile.mkdtemp())
+
+User.load_from_file()
+
+# Reloads while a compaction runs keep every user
+lost = 0
+for round in range(20):
+    for i in range(100):
+        User(email="user{}-{}@example.com".format(round, i)).save()
+    User.load_from_file()
+    lost += (round + 1) * 100 - User.count()
+    User.wait_for_compaction()
+    User.load_from_file()
+    lost += (round + 1) * 100 - User.count()
+print("reload during compaction, users lost:", lost)
+
+# A last record written but for its newline still counts after the next
+# change is appended
+os.environ['JOURNAL_COMPACT_SIZE'] = str(2 ** 30)
+User.wait_for_compaction()
+user = User(email="removed@example.com")
+user.save()
+user.remove()
+with open(".db_User.journal", 'rb+') as f:
+    f.seek(-1, os.SEEK_END)
+    f.truncate()
+User.load_from_file()
+other = User(email="next@example.com")
+other.save()
+User.load_from_file()
+print("unterminated record kept:",
+      User.get(user.id) is None and User.get(other.id) is not None)
+
+# A failed compaction puts its journal back, the next one succeeds
+write_snapshot = User._write_snapshot
+User._write_snapshot = classmethod(lambda cls, objs_json: 1 / 0)
+threading.excepthook = lambda args: None
+os.environ['JOURNAL_COMPACT_SIZE'] = '2000'
+count = User.count()
+for i in range(50):
+    User(email="failed{}@example.com".format(i)).save()
+User.wait_for_compaction()
+failed = os.path.exists(".db_User.journal.compacting")
+User._write_snapshot = write_snapshot
+User(email="retried@example.com").save()
+User.wait_for_compaction()
+User.load_from_file()
+print("failed compaction retried:", not failed and User.count() == count + 51
+      and not os.path.exists(".db_User.journal.compacting"))
+
+# Concurrent saves in file mode all write their snapshot
+os.environ['STORAGE_MODE'] = 'file'
+errors = []
+
+
+def save_users(worker: int):
+    """ Save users, recording the errors
+    """
+    for i in range(50):
+        try:
+            User(email="w{}-{}@example.com".format(worker, i)).save()
+        except Exception as e:
+            errors.append(e)
+
+
+threads = [threading.Thread(target=save_users, args=(worker,))
+           for worker in range(8)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+count = User.count()
+User.load_from_file()
+print("concurrent snapshot writes:", not errors and User.count() == count)
+
+# A nested value can't pass for a record of the lazily loaded store
+os.environ['LAZY_LOAD'] = '1'
+user = User(email="nested@example.com")
+user.first_name = {"p": {"q": 1}, "fake-id": {"r": 2}}
+user.save()
+count = User.count()
+User.load_from_file()
+print("nested value loaded lazily:", User.count() == count and
+      User.get("fake-id") is None and
+      User.get(user.id).first_name == user.first_name)
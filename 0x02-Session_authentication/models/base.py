@@ -1,20 +1,218 @@
 #!/usr/bin/env python3
 """ Base module
 """
+from bisect import bisect_right
+from collections.abc import MutableMapping
 from datetime import datetime
-from typing import TypeVar, List, Iterable
-from os import path
+from itertools import chain
+from typing import TypeVar, List, Iterable, Iterator, Tuple
+from os import getenv, path
+import atexit
 import json
+import mmap
+import os
+import re
+import tempfile
+import threading
 import uuid
 
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
 DATA = {}
+# Secondary indexes: class name -> attribute -> value -> {id: None}, the
+# inner dicts are ordered sets of IDs
+INDEXES = {}
+
+# Storage modes, picked with STORAGE_MODE: 'file' rewrites .db_<Class>.json
+# on every change, 'journal' appends the change to .db_<Class>.journal and
+# compacts the journal into the .json snapshot once it grows past
+# JOURNAL_COMPACT_SIZE bytes, 'deferred' rewrites .db_<Class>.json from a
+# background thread at most once per FLUSH_INTERVAL seconds, or as soon as
+# FLUSH_MAX_PENDING changes are waiting
+STORAGE_MODES = ('file', 'journal', 'deferred')
+JOURNAL_COMPACT_SIZE = 4 * 1024 * 1024
+FLUSH_INTERVAL = 1.0
+FLUSH_MAX_PENDING = 100
+# Makes the snapshot copied last the one written last
+_snapshot_lock = threading.Lock()
+# Guards the journals, and the compaction running per class if any
+_journal_lock = threading.Lock()
+_compactions = {}
+# Deferred mode: classes with changes not written yet, with their number
+# of changes, and the flusher thread once started
+_dirty = {}
+_flush_condition = threading.Condition()
+_flush_lock = threading.RLock()
+_flusher = None
+# Deferred mode counters per class name: changes, file writes, and the
+# changes that were written by the write of another one
+FLUSH_STATS = {}
+
+# Lazy loading, enabled with LAZY_LOAD=1: where the objects of a
+# .db_<Class>.json written by save_to_file() start, and the JSON values
+# found in them
+# A record: its ID then its object, without nested objects nor arrays,
+# strings skipped whole
+RECORD = re.compile(
+    rb'[{ ]"([^"\\]*(?:\\.[^"\\]*)*)": '
+    rb'(\{[^"{}\[\]]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"{}\[\]]*)*\})[,}]')
+JSON_VALUE = rb'"[^"\\]*(?:\\.[^"\\]*)*"|null|true|false|-?[0-9][^,}]*'
+
+# Value of a declared attribute never set
+_UNSET = object()
+
+
+class LazyStore(MutableMapping):
+    """ Objects of a class, loaded on demand from a memory-mapped file
+    Loading only records where each object lies in the file, an object
+    is built the first time it is accessed. It stands in for the dict of
+    DATA, objects saved afterwards are held as is.
+    """
+
+    def __init__(self, cls: type, file_path: str):
+        """ Map the file and find the objects in it
+        Raises ValueError if the file is not laid out like save_to_file()
+        writes it, one flat JSON object per ID.
+        """
+        self._cls = cls
+        self._lock = threading.Lock()
+        with open(file_path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # ID -> object, or the (start, end) offsets of its JSON until used
+        self._objects = {}
+        self._starts = []
+        self._ids = []
+        data = self._map
+        # Each record must start right where the previous one ends, so a
+        # nested value can't pass for one
+        end = 0
+        for match in RECORD.finditer(data):
+            if match.start() != end:
+                break
+            key = match.group(1)
+            obj_id = json.loads(b'"' + key + b'"') if b'\\' in key \
+                else key.decode()
+            start, end = match.span(2)
+            self._objects[obj_id] = (start, end)
+            self._starts.append(start)
+            self._ids.append(obj_id)
+            # The next one starts at the space after the comma
+            end += 1
+        if end == 0 and data[:].strip() != b'{}' or \
+                end and (end != len(data) or data[end - 1:] != b'}'):
+            self._map.close()
+            raise ValueError("{} is not a flat JSON object store".format(
+                file_path))
+
+    def _raw(self, offsets: Tuple[int, int]) -> dict:
+        """ Decode the JSON of an object not built yet
+        """
+        start, end = offsets
+        return json.loads(self._map[start:end])
+
+    def __getitem__(self, obj_id: str):
+        """ Get an object, building it on first access
+        """
+        entry = self._objects[obj_id]
+        if type(entry) is tuple:
+            with self._lock:
+                entry = self._objects[obj_id]
+                if type(entry) is tuple:
+                    entry = self._cls(**self._raw(entry))
+                    self._objects[obj_id] = entry
+        return entry
+
+    def __setitem__(self, obj_id: str, obj):
+        """ Store an object
+        """
+        self._objects[obj_id] = obj
+
+    def __delitem__(self, obj_id: str):
+        """ Remove an object
+        """
+        del self._objects[obj_id]
+
+    def __iter__(self) -> Iterator[str]:
+        """ Iterate over the IDs, without building any object
+        """
+        return iter(self._objects)
+
+    def __len__(self) -> int:
+        """ Number of objects, built or not
+        """
+        return len(self._objects)
+
+    def peek(self, obj_id: str):
+        """ Get an object only if it is already built, None otherwise
+        """
+        entry = self._objects.get(obj_id)
+        return None if type(entry) is tuple else entry
+
+    def json_items(self) -> Iterator[Tuple[str, dict]]:
+        """ Serialized objects, as to_json(True) gives them
+        Objects not built yet are decoded from the file, not built. The
+        list of objects is taken on the call, not on the iteration.
+        """
+        entries = list(self._objects.items())
+        return ((obj_id, self._raw(entry) if type(entry) is tuple
+                 else entry.to_json(True)) for obj_id, entry in entries)
+
+    def attribute_values(self, attr: str) -> Iterator[Tuple[str, object]]:
+        """ Value of an attribute for every object, built or not
+        The values of the objects not built yet are read from the file
+        with one scan, an object without the attribute gives None.
+        """
+        found = {}
+        pattern = re.compile(b'"' + re.escape(
+            json.dumps(attr)[1:-1].encode()) + b'": (' + JSON_VALUE + b')')
+        starts, ids = self._starts, self._ids
+        for match in pattern.finditer(self._map):
+            found[ids[bisect_right(starts, match.start()) - 1]] = \
+                match.group(1)
+        for obj_id, entry in list(self._objects.items()):
+            if type(entry) is not tuple:
+                yield obj_id, getattr(entry, attr, None)
+                continue
+            raw = found.get(obj_id)
+            if raw is None or raw == b'null':
+                yield obj_id, None
+            elif raw[:1] == b'"' and b'\\' not in raw:
+                # Plain strings, most of them, don't need the JSON decoder
+                yield obj_id, raw[1:-1].decode()
+            else:
+                yield obj_id, json.loads(raw)
+
+
+def _json_items(objs) -> Iterator[Tuple[str, dict]]:
+    """ Serialized objects of a class, taken from DATA on the call
+    """
+    if isinstance(objs, LazyStore):
+        return objs.json_items()
+    entries = list(objs.items())
+    return ((obj_id, obj.to_json(True)) for obj_id, obj in entries)
 
 
 class Base():
     """ Base class
+    Subclasses declare their attributes in `__slots__`, instances then
+    have no per-object __dict__, and to_json() gives the attributes in
+    declaration order. Subclasses list the attributes to index in
+    `_indexed_attributes`, search() then looks objects up by value instead
+    of scanning them all. to_json() keeps its result until an attribute
+    is set again
     """
+    __slots__ = ('id', 'created_at', 'updated_at', '_json_cache')
+    # Attributes declared by the class and its parents, in order
+    _fields = ('id', 'created_at', 'updated_at')
+    _indexed_attributes = ()
+
+    def __init_subclass__(cls, **kwargs: dict):
+        """ Collect the attributes declared by a subclass
+        """
+        super().__init_subclass__(**kwargs)
+        cls._fields = cls._fields + tuple(
+            name for name in cls.__dict__.get('__slots__', ())
+            if name not in ('__dict__', '__weakref__'))
 
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
@@ -35,6 +233,267 @@ class Base():
         else:
             self.updated_at = datetime.utcnow()
 
+    def __setattr__(self, name: str, value):
+        """ Set an attribute, keeping the indexes of stored objects in sync
+        and dropping the cached serialization
+        """
+        object.__setattr__(self, '_json_cache', None)
+        if name in self._indexed_attributes and self._is_stored():
+            self._unindex(name)
+            object.__setattr__(self, name, value)
+            self._index(name)
+        else:
+            object.__setattr__(self, name, value)
+
+    def _is_stored(self) -> bool:
+        """ Whether this very object is the one stored under its ID
+        """
+        objs = DATA.get(self.__class__.__name__)
+        if objs is None:
+            return False
+        obj_id = getattr(self, 'id', None)
+        if isinstance(objs, LazyStore):
+            # Never build an object here, this runs while building one
+            return objs.peek(obj_id) is self
+        return objs.get(obj_id) is self
+
+    @classmethod
+    def _class_indexes(cls) -> dict:
+        """ Indexes of the class, created empty on first use
+        """
+        s_class = cls.__name__
+        indexes = INDEXES.get(s_class)
+        if indexes is None:
+            indexes = INDEXES[s_class] = {
+                attr: {} for attr in cls._indexed_attributes}
+        return indexes
+
+    def _index(self, *attrs: str):
+        """ Add the object to the indexes of some or all attributes
+        """
+        indexes = self._class_indexes()
+        for attr in attrs or self._indexed_attributes:
+            index = indexes.get(attr)
+            if index is None:
+                continue
+            try:
+                index.setdefault(getattr(self, attr, None), {})[self.id] = None
+            except TypeError:
+                # An unhashable value can't be indexed, scan for this one
+                indexes[attr] = None
+
+    def _unindex(self, *attrs: str):
+        """ Remove the object from the indexes of some or all attributes
+        """
+        indexes = self._class_indexes()
+        for attr in attrs or self._indexed_attributes:
+            index = indexes.get(attr)
+            if index is None:
+                continue
+            value = getattr(self, attr, None)
+            bucket = index.get(value)
+            if bucket is not None and self.id in bucket:
+                del bucket[self.id]
+                if not bucket:
+                    del index[value]
+
+    @classmethod
+    def _reindex(cls):
+        """ Rebuild the indexes of the class from DATA
+        Objects of a LazyStore are indexed without being built
+        """
+        indexes = INDEXES[cls.__name__] = {
+            attr: {} for attr in cls._indexed_attributes}
+        objs = DATA[cls.__name__]
+        if not isinstance(objs, LazyStore):
+            for obj in objs.values():
+                obj._index()
+            return
+        for attr in cls._indexed_attributes:
+            index = indexes[attr]
+            for obj_id, value in objs.attribute_values(attr):
+                try:
+                    index.setdefault(value, {})[obj_id] = None
+                except TypeError:
+                    indexes[attr] = None
+                    break
+
+    @staticmethod
+    def _storage_mode() -> str:
+        """ Storage mode from STORAGE_MODE, 'file' by default
+        """
+        mode = getenv('STORAGE_MODE', 'file')
+        if mode not in STORAGE_MODES:
+            raise ValueError("STORAGE_MODE must be one of {}".format(
+                ", ".join(STORAGE_MODES)))
+        return mode
+
+    @classmethod
+    def _write_snapshot(cls, objs_json: dict):
+        """ Write the objects to .db_<Class>.json, atomically
+        """
+        file_path = ".db_{}.json".format(cls.__name__)
+        fd, temp_path = tempfile.mkstemp(prefix=file_path + '.',
+                                         suffix='.tmp', dir='.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(objs_json, f)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    @classmethod
+    def _replay_journal(cls, file_path: str):
+        """ Apply the records of a journal to DATA
+        A last line cut short by a crash is dropped from the file, a last
+        record complete but for its newline gets it back
+        """
+        s_class = cls.__name__
+        if not path.exists(file_path):
+            return
+        with open(file_path, 'rb+') as f:
+            offset = 0
+            line = b''
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    if line.endswith(b'\n'):
+                        # Damaged in the middle, the next ones still count
+                        offset += len(line)
+                        continue
+                    # Torn write: cut it so the next append starts clean
+                    f.truncate(offset)
+                    return
+                offset += len(line)
+                if record.get('op') == 'remove':
+                    DATA[s_class].pop(record.get('id'), None)
+                elif record.get('op') == 'save':
+                    obj = cls(**record['obj'])
+                    DATA[s_class][obj.id] = obj
+            if line and not line.endswith(b'\n'):
+                # Else the next append would join this record's line
+                f.seek(0, os.SEEK_END)
+                f.write(b'\n')
+
+    def _append_journal(self, op: str):
+        """ Append one change of this object to the journal of its class
+        """
+        cls = self.__class__
+        if op == 'save':
+            record = {'op': op, 'obj': self.to_json(True)}
+        else:
+            record = {'op': op, 'id': self.id}
+        line = json.dumps(record) + '\n'
+        file_path = ".db_{}.journal".format(cls.__name__)
+        with _journal_lock:
+            with open(file_path, 'a') as f:
+                f.write(line)
+                size = f.tell()
+            compact_size = int(getenv('JOURNAL_COMPACT_SIZE',
+                                      JOURNAL_COMPACT_SIZE))
+            if size >= compact_size and \
+                    cls.__name__ not in _compactions:
+                cls._start_compaction(file_path)
+
+    @classmethod
+    def _start_compaction(cls, file_path: str):
+        """ Fold the journal into the snapshot on a background thread
+        The journal is moved aside so new changes go to a fresh one, the
+        snapshot written from the objects in memory covers everything the
+        moved journal holds. If writing the snapshot fails, the moved
+        journal is put back, a later append tries again. Runs with
+        _journal_lock held.
+        """
+        s_class = cls.__name__
+        compacting_path = file_path + '.compacting'
+        if path.exists(compacting_path):
+            # A previous compaction didn't finish, its journal still counts
+            return
+        os.replace(file_path, compacting_path)
+        objs_json = _json_items(DATA[s_class])
+
+        def compact():
+            try:
+                cls._write_snapshot(dict(objs_json))
+                os.remove(compacting_path)
+            except Exception:
+                with _journal_lock:
+                    cls._restore_journal(file_path)
+                raise
+            finally:
+                with _journal_lock:
+                    del _compactions[s_class]
+
+        thread = threading.Thread(target=compact, daemon=True,
+                                  name="compact-{}".format(s_class))
+        _compactions[s_class] = thread
+        thread.start()
+
+    @staticmethod
+    def _restore_journal(file_path: str):
+        """ Put back the journal of a failed compaction
+        The changes journaled since are appended to it. Runs with
+        _journal_lock held.
+        """
+        compacting_path = file_path + '.compacting'
+        if not path.exists(compacting_path):
+            return
+        if path.exists(file_path):
+            with open(file_path, 'rb') as src, \
+                    open(compacting_path, 'ab') as dst:
+                for line in src:
+                    dst.write(line)
+        os.replace(compacting_path, file_path)
+
+    @classmethod
+    def _mark_dirty(cls):
+        """ Record a change to write later, in deferred mode
+        """
+        global _flusher
+        s_class = cls.__name__
+        max_pending = int(getenv('FLUSH_MAX_PENDING', FLUSH_MAX_PENDING))
+        with _flush_condition:
+            pending = _dirty.get(s_class, (cls, 0))[1] + 1
+            _dirty[s_class] = (cls, pending)
+            stats = FLUSH_STATS.setdefault(
+                s_class, {'changes': 0, 'writes': 0, 'coalesced': 0})
+            stats['changes'] += 1
+            if _flusher is None:
+                _flusher = threading.Thread(target=_flush_loop, daemon=True,
+                                            name="models-flusher")
+                _flusher.start()
+            if pending == 1 or pending >= max_pending:
+                _flush_condition.notify()
+
+    @classmethod
+    def flush(cls):
+        """ Write the pending changes of the class now, in deferred mode
+        Called on Base, writes the pending changes of every class
+        """
+        with _flush_lock:
+            with _flush_condition:
+                if cls is Base:
+                    dirty = list(_dirty.values())
+                    _dirty.clear()
+                else:
+                    dirty = [_dirty.pop(cls.__name__)] \
+                        if cls.__name__ in _dirty else []
+            for dirty_cls, pending in dirty:
+                dirty_cls.save_to_file()
+                stats = FLUSH_STATS[dirty_cls.__name__]
+                stats['writes'] += 1
+                stats['coalesced'] += pending - 1
+
+    @classmethod
+    def wait_for_compaction(cls):
+        """ Wait for the running compaction of the class, if any
+        """
+        thread = _compactions.get(cls.__name__)
+        if thread is not None:
+            thread.join()
+
     def __eq__(self, other: TypeVar('Base')) -> bool:
         """ Equality
         """
@@ -46,60 +505,132 @@ class Base():
 
     def to_json(self, for_serialization: bool = False) -> dict:
         """ Convert the object a JSON dictionary
+        The serialization is cached until an attribute is set, a value
+        changed in place (a list appended to...) isn't noticed
+        """
+        cache = getattr(self, '_json_cache', None)
+        if type(cache) is not dict:
+            cache = self._serialize()
+        if for_serialization:
+            return dict(cache)
+        return {key: value for key, value in cache.items() if key[0] != '_'}
+
+    def _serialize(self) -> dict:
+        """ Serialize every attribute and cache the result
         """
+        # Set while serializing: an attribute set meanwhile replaces it
+        # with None, and the result, maybe stale, isn't kept
+        marker = object()
+        object.__setattr__(self, '_json_cache', marker)
         result = {}
-        for key, value in self.__dict__.items():
-            if not for_serialization and key[0] == '_':
+        # A subclass without __slots__ gets a __dict__ for its own ones
+        extra = getattr(self, '__dict__', {})
+        for key in chain(self._fields, extra):
+            value = getattr(self, key, _UNSET)
+            if value is _UNSET:
                 continue
             if type(value) is datetime:
                 result[key] = value.strftime(TIMESTAMP_FORMAT)
             else:
                 result[key] = value
+        if getattr(self, '_json_cache', None) is marker:
+            object.__setattr__(self, '_json_cache', result)
         return result
 
     @classmethod
     def load_from_file(cls):
         """ Load all objects from file
+        In journal mode, the changes journaled since the snapshot are
+        replayed on top of it. With LAZY_LOAD=1, objects are only built
+        when first accessed, see LazyStore
         """
         s_class = cls.__name__
         file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
-        if not path.exists(file_path):
+        if cls._storage_mode() != 'journal':
+            cls._load_snapshot(file_path)
+            cls._reindex()
             return
+        # A running compaction removes its journal once its snapshot is
+        # written: wait for it, and start none until both are read
+        while True:
+            with _journal_lock:
+                thread = _compactions.get(s_class)
+                if thread is None:
+                    cls._load_snapshot(file_path)
+                    journal_path = ".db_{}.journal".format(s_class)
+                    cls._replay_journal(journal_path + '.compacting')
+                    cls._replay_journal(journal_path)
+                    break
+            thread.join()
+        if path.exists(journal_path + '.compacting'):
+            # Left over by a crash during a compaction, finish it
+            cls.save_to_file()
+            os.remove(journal_path + '.compacting')
+        cls._reindex()
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+    @classmethod
+    def _load_snapshot(cls, file_path: str):
+        """ Load the objects of .db_<Class>.json into DATA
+        """
+        s_class = cls.__name__
+        DATA[s_class] = {}
+        lazy = getenv('LAZY_LOAD', '').lower() in ('1', 'true', 'yes')
+        if lazy and path.exists(file_path) and path.getsize(file_path):
+            try:
+                DATA[s_class] = LazyStore(cls, file_path)
+            except ValueError:
+                lazy = False
+        if not lazy and path.exists(file_path):
+            with open(file_path, 'r') as f:
+                objs_json = json.load(f)
+                for obj_id, obj_json in objs_json.items():
+                    DATA[s_class][obj_id] = cls(**obj_json)
 
     @classmethod
     def save_to_file(cls):
         """ Save all objects to file
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        with _snapshot_lock:
+            # Copied first, the flusher thread runs next to the request ones
+            objs_json = dict(_json_items(DATA[s_class]))
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+            cls._write_snapshot(objs_json)
 
     def save(self):
         """ Save current object
         """
         s_class = self.__class__.__name__
         self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        previous = DATA[s_class].get(self.id)
+        if previous is not self:
+            if previous is not None:
+                previous._unindex()
+            DATA[s_class][self.id] = self
+            self._index()
+        mode = self._storage_mode()
+        if mode == 'journal':
+            self._append_journal('save')
+        elif mode == 'deferred':
+            self._mark_dirty()
+        else:
+            self.__class__.save_to_file()
 
     def remove(self):
         """ Remove object
         """
         s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
+        previous = DATA[s_class].get(self.id)
+        if previous is not None:
+            previous._unindex()
             del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+            mode = self._storage_mode()
+            if mode == 'journal':
+                self._append_journal('remove')
+            elif mode == 'deferred':
+                self._mark_dirty()
+            else:
+                self.__class__.save_to_file()
 
     @classmethod
     def count(cls) -> int:
@@ -124,8 +655,23 @@ class Base():
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
+        An indexed attribute of the query narrows the objects to check down
+        to the ones having its value
         """
         s_class = cls.__name__
+        objs = DATA[s_class].values()
+        indexes = cls._class_indexes()
+        for k, v in attributes.items():
+            index = indexes.get(k)
+            if index is None:
+                continue
+            try:
+                ids = index.get(v, ())
+            except TypeError:
+                continue
+            objs = [DATA[s_class][obj_id] for obj_id in ids]
+            break
+
         def _search(obj):
             if len(attributes) == 0:
                 return True
@@ -133,5 +679,28 @@ class Base():
                 if (getattr(obj, k) != v):
                     return False
             return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+
+        return list(filter(_search, objs))
+
+
+def _flush_loop():
+    """ Body of the flusher thread of the deferred mode
+    Waits for a first change, then lets changes pile up for FLUSH_INTERVAL
+    seconds, or until FLUSH_MAX_PENDING of a class are waiting, and
+    writes every dirty class once
+    """
+    interval = float(getenv('FLUSH_INTERVAL', FLUSH_INTERVAL))
+    max_pending = int(getenv('FLUSH_MAX_PENDING', FLUSH_MAX_PENDING))
+    while True:
+        with _flush_condition:
+            while not _dirty:
+                _flush_condition.wait()
+            _flush_condition.wait_for(
+                lambda: any(pending >= max_pending
+                            for _, pending in _dirty.values()),
+                timeout=interval)
+        Base.flush()
+
+
+# Changes still pending when the process exits are written
+atexit.register(Base.flush)
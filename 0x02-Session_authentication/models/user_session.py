@@ -11,6 +11,8 @@ class UserSession(Base):
     """
     UserSession model that inherits from Base
     """
+    __slots__ = ('user_id', 'session_id')
+    _indexed_attributes = ('session_id', 'user_id')
 
     def __init__(self, *args: list, **kwargs: dict):
         """